@@ -1,16 +1,27 @@
-from flask import Flask, render_template, request, jsonify, Response, session, stream_with_context
+from flask import Flask, Blueprint, current_app, g, render_template, request, jsonify, Response, session, stream_with_context
 import os
 from dotenv import load_dotenv
 from functools import wraps
-from openai import OpenAI
+import concurrent.futures
+import threading
 import time
 import io
-import soundfile as sf
 import base64
 import re
-
-app = Flask(__name__)
-app.secret_key = 'secret_key'
+import uuid
+from werkzeug.exceptions import RequestEntityTooLarge
+from uploads import SpooledUploadRequest, SharedUpload, MAX_UPLOAD_BYTES, prepare_stt_file
+from audio_formats import TTS_MIME_TYPES, DEFAULT_TTS_FORMAT, negotiate_tts_format
+from audio_concat import CONCATENABLE_FORMATS, concat_audio
+from shared_state import state
+from recorder import start_turn, finish_turn
+from sse import sse_event, DeltaCoalescer, accepts_gzip, gzip_stream
+from model_selector import selector, TurnBudget, TURN_LATENCY_BUDGET
+from idempotency import idempotency_key, run_once
+from hedging import hedger
+from assets import assets
+
+bp = Blueprint('main', __name__)
 
 # Load API key and assistant ID from .env file
 load_dotenv()
@@ -18,6 +29,17 @@ API_KEY = os.getenv('OPENAI_API_KEY')
 ASSISTANT_ID = os.getenv('ASSISTANT_ID')
 USERNAME = os.getenv('BASIC_AUTH_USERNAME', 'admin')
 PASSWORD = os.getenv('BASIC_AUTH_PASSWORD', 'password')
+# stub を指定するとローカルのスタブ (stub_backend.py) を使う
+OPENAI_BACKEND = os.getenv('OPENAI_BACKEND', 'openai')
+# ストリーミング音声合成で転送するチャンクのバイト数
+TTS_CHUNK_BYTES = int(os.getenv('TTS_CHUNK_BYTES', '4096'))
+# 長い文章はこの文字数を目安に文の区切りで分け、並列に合成してつなぐ
+TTS_PARALLEL_CHUNK_CHARS = int(os.getenv('TTS_PARALLEL_CHUNK_CHARS', '200'))
+# 並列合成の同時実行数 (プロセス全体で共有)
+TTS_PARALLEL_WORKERS = int(os.getenv('TTS_PARALLEL_WORKERS', '4'))
+# セッションと会話スレッドの対応を共有状態に残す秒数 (既定は Flask のセッションの有効期間と同じ 31 日)
+SESSION_THREAD_TTL = int(os.getenv('SESSION_THREAD_TTL', str(31 * 24 * 3600)))
+tts_executor = concurrent.futures.ThreadPoolExecutor(TTS_PARALLEL_WORKERS, thread_name_prefix='tts')
 
 class SingletonMeta(type):
     _instances = {}
@@ -28,58 +50,186 @@ class SingletonMeta(type):
             cls._instances[cls] = instance
         return cls._instances[cls]
 
+def create_openai_client(api_key):
+    if OPENAI_BACKEND == 'stub':
+        from stub_backend import StubOpenAI
+        return StubOpenAI(api_key=api_key)
+    # openai の import 自体が重いので、クライアントを作るときに読み込む
+    from openai import OpenAI
+    return OpenAI(api_key=api_key)
+
 class AIAssistant(metaclass=SingletonMeta):
     def __init__(self, assistant_id, api_key):
         self.assistant_id = assistant_id
-        self.client = OpenAI(api_key=api_key)
+        self.api_key = api_key
         self.stt_model = "whisper-1"
         self.tts_model = "tts-1"
         self.voice_code = "nova"
-        self.thread_id = self.client.beta.threads.create().id
+        self.ready = False
+        self.warm_up_error = None
+        self._client = None
+        self._lock = threading.Lock()
+        self._warm_up_thread = None
+
+    # OpenAI クライアントは初回利用時に生成する
+    @property
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = create_openai_client(self.api_key)
+        return self._client
+
+    # クライアントを生成して上流との疎通を確認する。成功するまでバックオフしながら再試行
+    def warm_up(self, max_backoff=30.0):
+        backoff = 1.0
+        while not self.ready:
+            try:
+                self.client.beta.assistants.retrieve(self.assistant_id)
+            except Exception as e:
+                self.warm_up_error = repr(e)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, max_backoff)
+            else:
+                self.warm_up_error = None
+                self.ready = True
+
+    # バックグラウンドで warm_up を開始する (何度呼んでも1回だけ)
+    def start_warm_up(self):
+        with self._lock:
+            if self._warm_up_thread is None:
+                self._warm_up_thread = threading.Thread(target=self.warm_up, name='assistant-warm-up', daemon=True)
+                self._warm_up_thread.start()
+
+    # 共有スレッド (全ワーカー共通)
+    @property
+    def thread_id(self):
+        return self.thread_for('default')
+
+    # キーに対応するスレッドを共有状態から引き、無ければ作成する
+    # 複数ワーカーが同時に作成した場合は先に保存された方を使う
+    def thread_for(self, key):
+        thread_id = state.get('threads', key)
+        if thread_id is None:
+            thread_id = state.setdefault('threads', key, self.client.beta.threads.create().id, ttl=SESSION_THREAD_TTL)
+        return thread_id
+
+    # レイテンシ予算があれば予算内に収まるモデルを選ぶ。無ければ既定のモデル
+    def select_model(self, stage, default, budget=None, size=1):
+        if budget is None:
+            return default
+        model = selector.select(stage, budget.for_stage(stage), size) or default
+        if model:
+            budget.models[stage] = model
+        return model
 
     # ユーザー入力の文字起こし
-    def transcribe_audio(self, audio_stream):
-        # ファイルを読み込んでAPIに送信
-        # with open(file_path, 'rb') as audio_file:
-        #     transcript = self.client.audio.transcriptions.create(model=self.stt_model, file=audio_file)
-        # バイトストリームをwav形式に変換
-        data, samplerate = sf.read(audio_stream)
-        wav_io = io.BytesIO()
-        wav_io.name = "input.wav"
-        sf.write(wav_io, data, samplerate, format='WAV')
-        wav_io.seek(0)  # バッファの先頭に戻す
-
-        transcript = self.client.audio.transcriptions.create(model=self.stt_model, file=wav_io)
+    def transcribe_audio(self, audio_stream, filename=None, budget=None):
+        # API が受け付ける形式ならそのまま、それ以外はブロック単位でWAVに変換して送信
+        stt_name, stt_stream = prepare_stt_file(audio_stream, filename)
+        model = self.select_model('stt', self.stt_model, budget)
+        if hedger.enabled('stt'):
+            # ヘッジした2本目も同じアップロードを頭から読めるよう、読み取り位置を共有しないリーダーで渡す
+            upload = SharedUpload(stt_stream)
+            open_file = lambda: (stt_name, upload.reader())
+        else:
+            open_file = lambda: (stt_name, stt_stream)
+        started = time.perf_counter()
+        transcript = hedger.call(
+            'stt', model, lambda cancelled: self.client.audio.transcriptions.create(model=model, file=open_file()))
+        selector.observe(model, time.perf_counter() - started)
         return transcript.text
     
     # LLMの応答生成
-    def run_thread_actions(self, text):
-        self.client.beta.threads.messages.create(thread_id=self.thread_id, role="user", content=text)
-        run = self.client.beta.threads.runs.create(thread_id=self.thread_id, assistant_id=self.assistant_id)
+    # thread_id を省略した場合は共有スレッドを使う
+    # model が None のときはアシスタントに設定されたモデルで応答する
+    def run_thread_actions(self, text, thread_id=None, budget=None):
+        thread_id = thread_id or self.thread_id
+        model = self.select_model('llm', None, budget)
+        started = time.perf_counter()
+        self.client.beta.threads.messages.create(thread_id=thread_id, role="user", content=text)
+        run_options = {'model': model} if model else {}
+        run = self.client.beta.threads.runs.create(thread_id=thread_id, assistant_id=self.assistant_id, **run_options)
         while True:
-            result = self.client.beta.threads.runs.retrieve(thread_id=self.thread_id, run_id=run.id)
+            result = self.client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
             if result.status == 'completed':
                 break
             time.sleep(0.5)
-        messages = self.client.beta.threads.messages.list(thread_id=self.thread_id, order='asc')
+        selector.observe(model, time.perf_counter() - started)
+        messages = self.client.beta.threads.messages.list(thread_id=thread_id, order='asc')
         if len(messages.data) < 2:
             return ""
         return messages.data[-1].content[0].text.value
 
     # 応答音声の生成
-    def text_to_speech(self, text):
-        response = self.client.audio.speech.create(model=self.tts_model, voice=self.voice_code, input=text)
-        return io.BytesIO(response.content)
+    # 合成時間は文字数に比例するので、文字数あたりのレイテンシでモデルを選ぶ
+    # 長い文章は文の区切りで分けて並列に合成し、デコードせずに1つの音声につなぐ
+    def text_to_speech(self, text, response_format=DEFAULT_TTS_FORMAT, budget=None):
+        parts = [text]
+        if response_format in CONCATENABLE_FORMATS:
+            parts = self.split_text_for_parallel_tts(text)
+        size = max(len(part) for part in parts)
+        model = self.select_model('tts', self.tts_model, budget, size=size)
+        started = time.perf_counter()
+        if len(parts) == 1:
+            content = self._speech_content(model, text, response_format)
+        else:
+            contents = tts_executor.map(lambda part: self._speech_content(model, part, response_format), parts)
+            content = concat_audio(list(contents), response_format)
+        selector.observe(model, time.perf_counter() - started, size=size)
+        return io.BytesIO(content)
+
+    def _speech_content(self, model, text, response_format):
+        if hedger.enabled('tts'):
+            # 負けた方は途中で接続を閉じられるよう、ストリーミングで受け取る
+            return hedger.call('tts', model, lambda cancelled: b''.join(
+                self._speech_chunks(model, text, response_format, TTS_CHUNK_BYTES, cancelled)), size=len(text))
+        return self.client.audio.speech.create(
+            model=model, voice=self.voice_code, input=text, response_format=response_format).content
+
+    # 応答音声をストリーミングで生成し、届いたチャンクから順に返す
+    def text_to_speech_stream(self, text, response_format=DEFAULT_TTS_FORMAT, chunk_size=TTS_CHUNK_BYTES, budget=None):
+        model = self.select_model('tts', self.tts_model, budget, size=len(text))
+        started = time.perf_counter()
+        yield from hedger.stream('tts', model, lambda cancelled: self._speech_chunks(
+            model, text, response_format, chunk_size, cancelled), size=len(text))
+        selector.observe(model, time.perf_counter() - started, size=len(text))
+
+    # 合成音声をチャンクで受け取る。cancelled が立ったら接続を閉じて打ち切る
+    def _speech_chunks(self, model, text, response_format, chunk_size, cancelled):
+        with self.client.audio.speech.with_streaming_response.create(
+                model=model, voice=self.voice_code, input=text, response_format=response_format) as response:
+            for chunk in response.iter_bytes(chunk_size):
+                yield chunk
+                if cancelled.is_set():
+                    return
+
+    # 割り込まれた run を止める。既に終わっている場合などの失敗は無視する
+    def cancel_run(self, thread_id, run_id):
+        try:
+            self.client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run_id)
+        except Exception:
+            pass
 
     def split_text_for_tts(self, text):
         sentences = re.split(r'(?<=。)', text)
         return sentences
 
+    # 並列合成用に、文の区切りで max_chars 程度の塊にまとめる (1文が長い場合はその文だけで1つ)
+    def split_text_for_parallel_tts(self, text, max_chars=TTS_PARALLEL_CHUNK_CHARS):
+        parts = []
+        for sentence in re.split(r'(?<=[。！？\n])|(?<=[.!?])(?=\s)', text):
+            if parts and len(parts[-1]) + len(sentence) <= max_chars:
+                parts[-1] += sentence
+            elif sentence:
+                parts.append(sentence)
+        return [part for part in parts if part.strip()] or [text]
+
     # 全てを順番に実行するラップ関数
-    def reply_process(self, audio_stream):
-        transcribed_text = self.transcribe_audio(audio_stream)
-        reply_message = self.run_thread_actions(transcribed_text)
-        audio_byte_stream = self.text_to_speech(reply_message)
+    def reply_process(self, audio_stream, filename=None, response_format=DEFAULT_TTS_FORMAT, thread_id=None, budget=None):
+        transcribed_text = self.transcribe_audio(audio_stream, filename, budget)
+        reply_message = self.run_thread_actions(transcribed_text, thread_id, budget)
+        audio_byte_stream = self.text_to_speech(reply_message, response_format, budget)
 
         return transcribed_text, reply_message, audio_byte_stream
 
@@ -105,22 +255,107 @@ def requires_auth(f):
 
 assistant = AIAssistant(assistant_id=ASSISTANT_ID, api_key=API_KEY)
 
-@app.before_request
+# セッションごとの会話スレッド (どのワーカーに来ても同じスレッドを使う)
+def session_id():
+    if 'sid' not in session:
+        session['sid'] = uuid.uuid4().hex
+    return session['sid']
+
+def session_thread_id():
+    return assistant.thread_for(session_id())
+
+# 応答中のターン。割り込まれたターンは cancelled_turns に記録し、生成中のストリームを打ち切る
+TURN_STATE_TTL = 3600
+
+def cancel_active_turn(turn_id=None):
+    active = state.get('active_turn', session_id())
+    turn_id = turn_id or active
+    if turn_id:
+        state.set('cancelled_turns', turn_id, True, ttl=TURN_STATE_TTL)
+        # 古い turn_id が送られてきたときは、応答中の別のターンの登録を消さない
+        if turn_id == active:
+            state.delete('active_turn', session_id())
+    return turn_id
+
+def begin_reply_turn():
+    cancel_active_turn()
+    turn_id = uuid.uuid4().hex
+    state.set('active_turn', session_id(), turn_id, ttl=TURN_STATE_TTL)
+    return turn_id
+
+def turn_cancelled(turn_id):
+    return turn_id is not None and state.get('cancelled_turns', turn_id, False)
+
+# 1ターンのレイテンシ予算。/transcribe・/start で始めたターンの締め切りを後続のリクエストに引き継ぐ
+def turn_budget(stages, new_turn=False):
+    deadline = session.get('turn_deadline')
+    if new_turn or deadline is None or deadline < time.time() - TURN_LATENCY_BUDGET:
+        deadline = time.time() + TURN_LATENCY_BUDGET
+        session['turn_deadline'] = deadline
+    return TurnBudget(deadline, stages)
+
+@bp.before_app_request
 def before_request():
+    # 静的ファイルはセッションに触れない (Set-Cookie や Vary: Cookie が付くとキャッシュされにくくなる)
+    if request.endpoint in ('static', 'main.asset'):
+        return
+    # gunicorn 以外 (flask run など) で起動した場合は最初のリクエストで warm-up を始める
+    assistant.start_warm_up()
+    # 存在しない URL (404) は数えない
+    if request.endpoint is not None:
+        state.incr(f'requests.{request.endpoint}')
     if 'status' not in session:
         session['status'] = '停止中'
-
-@app.route('/')
+    # 最初の /transcribe・/start の応答が届かずに再送されても同じセッションとして重複を判定できるよう、
+    # ページを開いた時点でセッション ID を決めておく
+    session_id()
+    # SESSION_RECORD_DIR が設定されていればターンを記録する
+    g.turn = start_turn(request, session_id)
+
+@bp.after_app_request
+def after_request(response):
+    turn = g.pop('turn', None)
+    if turn is not None:
+        finish_turn(turn, response)
+    return response
+
+@bp.route('/')
 @requires_auth
 def index():
     session['status'] = '停止中'
     return render_template('index.html')
 
-@app.route('/status', methods=['GET'])
+# ハッシュ付きの静的ファイル (assets.py でビルドしたもの)
+@bp.route('/assets/<path:filename>')
+def asset(filename):
+    return assets.send(filename, request.headers.get('Accept-Encoding', ''))
+
+@bp.app_errorhandler(RequestEntityTooLarge)
+def upload_too_large(e):
+    return jsonify({'error': f"Upload exceeds {current_app.config['MAX_CONTENT_LENGTH']} bytes"}), 413
+
+@bp.route('/status', methods=['GET'])
 def get_status():
     return jsonify(status=session.get('status', '停止中'))
 
-@app.route('/start', methods=['POST'])
+# プロセスが生きているか
+@bp.route('/healthz', methods=['GET'])
+def healthz():
+    return jsonify(status='ok')
+
+# 上流 (OpenAI) との接続が温まっていて応答できるか
+@bp.route('/readyz', methods=['GET'])
+def readyz():
+    if not assistant.ready:
+        return jsonify(status='warming', error=assistant.warm_up_error), 503
+    return jsonify(status='ready')
+
+@bp.route('/metrics', methods=['GET'])
+def metrics():
+    return jsonify(counters=state.counters(), model_latency=selector.tracker.snapshot(),
+                   hedge_thresholds=hedger.snapshot())
+
+@bp.route('/start', methods=['POST'])
 def start():
     if 'audio' not in request.files:
         return jsonify({'error': 'No audio file in request'}), 400
@@ -129,30 +364,42 @@ def start():
     if audio_file.filename == '':
         return jsonify({'error': 'No selected file'}), 400
 
+    try:
+        audio_format = negotiate_tts_format(request.form.get('format'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
     # audio_path = os.path.join('uploads', 'recording.wav')
     # audio_file.save(audio_path)
-    # バイトストリームとして読み込む
-    audio_stream = io.BytesIO(audio_file.read())
-
-    # 応答生成
+    # 応答生成 (アップロードはリクエスト側でスプールされているのでコピーせずに渡す)
     # user_text, assistant_text, response_audio_path = assistant.reply_process(audio_path)
-    user_text, assistant_text, response_audio_stream = assistant.reply_process(audio_stream)
-
-    # バイトストリームをBase64に変換
-    audio_data = response_audio_stream.getvalue()
-    audio_base64 = base64.b64encode(audio_data).decode('utf-8')
-    # with open(response_audio_path, 'rb') as f:
-    #     audio_data = f.read()
-
-    # audio_base64 = base64.b64encode(audio_data).decode('utf-8')
-
-    return jsonify({
-        'user': user_text,
-        'assistant': assistant_text,
-        'audio': audio_base64
-    })
-
-@app.route('/transcribe', methods=['POST'])
+    def reply():
+        begin_reply_turn()
+        budget = turn_budget(('stt', 'llm', 'tts'), new_turn=True)
+        user_text, assistant_text, response_audio_stream = assistant.reply_process(
+            audio_file.stream, audio_file.filename, audio_format, session_thread_id(), budget)
+
+        # バイトストリームをBase64に変換
+        audio_data = response_audio_stream.getvalue()
+        audio_base64 = base64.b64encode(audio_data).decode('utf-8')
+        # with open(response_audio_path, 'rb') as f:
+        #     audio_data = f.read()
+
+        # audio_base64 = base64.b64encode(audio_data).decode('utf-8')
+
+        return {
+            'user': user_text,
+            'assistant': assistant_text,
+            'audio': audio_base64,
+            'mime': TTS_MIME_TYPES[audio_format],
+            'models': budget.models
+        }
+
+    # 再送された同じ録音は、処理中ならその結果を待ち、処理済みなら保存した結果を返す
+    key = idempotency_key(request, 'start', session_id(), audio_file.stream, extra=(audio_format,))
+    return jsonify(run_once(key, reply))
+
+@bp.route('/transcribe', methods=['POST'])
 def transcribe():
     if 'audio' not in request.files:
         return jsonify({'error': 'No audio file in request'}), 400
@@ -161,17 +408,23 @@ def transcribe():
     if audio_file.filename == '':
         return jsonify({'error': 'No selected file'}), 400
 
-    # バイトストリームとして読み込む
-    audio_stream = io.BytesIO(audio_file.read())
+    def transcribe_upload():
+        # ユーザーが話し始めたので、まだ応答中のターンがあれば打ち切る
+        cancel_active_turn()
 
-    # もじおこし
-    user_text = assistant.transcribe_audio(audio_stream)
+        # もじおこし (アップロードはリクエスト側でスプールされているのでコピーせずに渡す)
+        budget = turn_budget(('stt', 'llm', 'tts'), new_turn=True)
+        user_text = assistant.transcribe_audio(audio_file.stream, audio_file.filename, budget)
 
-    return jsonify({
-        'usertext': user_text,
-    })
+        return {
+            'usertext': user_text,
+        }
 
-@app.route('/llm', methods=['POST'])
+    # 再送された同じ録音は、処理中ならその結果を待ち、処理済みなら保存した結果を返す
+    key = idempotency_key(request, 'transcribe', session_id(), audio_file.stream)
+    return jsonify(run_once(key, transcribe_upload))
+
+@bp.route('/llm', methods=['POST'])
 def llm():
     if not request.is_json:
         return jsonify({'error': 'Request must be JSON'}), 400
@@ -182,13 +435,13 @@ def llm():
         return jsonify({'error': 'No message in request'}), 400
 
     user_text = data['message']
-    assistant_text = assistant.run_thread_actions(user_text)
+    assistant_text = assistant.run_thread_actions(user_text, session_thread_id(), turn_budget(('llm', 'tts')))
 
     return jsonify({
         'assistanttext': assistant_text,
     })
 
-@app.route('/tts', methods=['POST'])
+@bp.route('/tts', methods=['POST'])
 def tts():
     if not request.is_json:
         return jsonify({'error': 'Request must be JSON'}), 400
@@ -198,8 +451,19 @@ def tts():
     if 'message' not in data:
         return jsonify({'error': 'No message in request'}), 400
 
+    try:
+        audio_format = negotiate_tts_format(data.get('format'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
     assistant_text = data['message']
-    response_audio_stream = assistant.text_to_speech(assistant_text)
+    budget = turn_budget(('tts',))
+    if data.get('stream'):
+        # 合成されたチャンクをそのまま chunked で転送する
+        audio_chunks = assistant.text_to_speech_stream(assistant_text, audio_format, budget=budget)
+        return Response(stream_with_context(audio_chunks), mimetype=TTS_MIME_TYPES[audio_format])
+
+    response_audio_stream = assistant.text_to_speech(assistant_text, audio_format, budget)
 
     # バイトストリームをBase64に変換
     audio_data = response_audio_stream.getvalue()
@@ -208,57 +472,184 @@ def tts():
     # audio_base64 = base64.b64encode(audio_data).decode('utf-8')
 
     return jsonify({
-        'audio': audio_base64
+        'audio': audio_base64,
+        'mime': TTS_MIME_TYPES[audio_format]
     })
 
-@app.route('/llm_stream', methods=['GET', 'POST'])
+# 割り込み (barge-in)。クライアントは再生を止め、どこまで聞いたかを送ってくる
+@bp.route('/interrupt', methods=['POST'])
+def interrupt():
+    data = request.get_json(silent=True)
+    if data is None:
+        data = {}
+    # 共有状態に書き込む前に検証する
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Request body must be a JSON object'}), 400
+    if data.get('turn_id') is not None and not isinstance(data['turn_id'], str):
+        return jsonify({'error': 'turn_id must be a string'}), 400
+    heard = {key: data[key] for key in ('heard_ms', 'heard_chars', 'played_clips') if key in data}
+    for key, value in heard.items():
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not 0 <= value < float('inf'):
+            return jsonify({'error': f'{key} must be a non-negative number'}), 400
+
+    turn_id = cancel_active_turn(data.get('turn_id'))
+    if not turn_id:
+        return jsonify({'status': 'idle'})
+
+    state.set('heard', turn_id, heard, ttl=TURN_STATE_TTL)
+    state.incr('bargein.interrupts')
+    if 'heard_chars' in data:
+        state.incr('bargein.heard_chars', int(data['heard_chars']))
+    current_app.logger.info('turn %s interrupted: %s', turn_id, heard)
+    return jsonify({'status': 'interrupted', 'turn_id': turn_id})
+
+@bp.route('/llm_stream', methods=['GET', 'POST'])
 def llm_stream():
     if request.method == 'POST':
         data = request.get_json()
         if 'message' not in data:
             return jsonify({'error': 'No message in request'}), 400
+        try:
+            session['tts_format'] = negotiate_tts_format(data.get('format'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        session['tts_stream'] = bool(data.get('stream'))
         session['user_text'] = data['message']
         session['text_buffer'] = ''
-        return jsonify({'status': 'Streaming session started'})
+        session['turn_id'] = begin_reply_turn()
+        return jsonify({'status': 'Streaming session started', 'turn_id': session['turn_id']})
 
     elif request.method == 'GET':
         user_text = session.get('user_text')
         if not user_text:
             return jsonify({'error': 'No message in session'}), 400
+        audio_format = session.get('tts_format', DEFAULT_TTS_FORMAT)
+        audio_mime = TTS_MIME_TYPES[audio_format]
+        tts_stream = session.get('tts_stream', False)
+        turn_id = session.get('turn_id')
+        sid = session_id()
+        budget = turn_budget(('llm', 'tts'))
+        llm_model = assistant.select_model('llm', None, budget)
+        run_options = {'model': llm_model} if llm_model else {}
+
+        # 1文ぶんの音声イベントを生成する
+        # ストリーミング時は合成中のチャンクを audio_chunk として逐次送り、audio_end で区切る
+        # chars はクライアントがどこまで聞いたかを報告するのに使う
+        # 割り込まれたら合成途中でも打ち切る
+        def synthesize(sentence):
+            if turn_cancelled(turn_id):
+                return
+            if tts_stream:
+                for chunk in assistant.text_to_speech_stream(sentence, audio_format, budget=budget):
+                    audio_base64 = base64.b64encode(chunk).decode('utf-8')
+                    yield sse_event({'audio_chunk': audio_base64, 'mime': audio_mime})
+                    if turn_cancelled(turn_id):
+                        return
+                yield sse_event({'audio_end': True, 'chars': len(sentence)})
+            else:
+                tts_response = assistant.text_to_speech(sentence, audio_format, budget)
+                audio_base64 = base64.b64encode(tts_response.getvalue()).decode('utf-8')
+                yield sse_event({'audio': audio_base64, 'mime': audio_mime, 'chars': len(sentence)})
 
         @stream_with_context
         def generate():
+            if turn_cancelled(turn_id):
+                # 割り込み済みのターンは上流の run を始めずに終わらせる
+                # 空のまま閉じると EventSource が再接続して run を作り直すので、終わったことを伝える
+                yield sse_event({'completed': True, 'cancelled': True})
+                return
+            started = time.perf_counter()
+            # 文ごとの音声合成はこのループの中で行うので、LLM の所要時間からはその分を除く
+            tts_seconds = 0.0
             with assistant.client.beta.threads.create_and_run_stream(
                 assistant_id=assistant.assistant_id,
-                thread={"messages": [{"role": "user", "content": user_text}]}
+                thread={"messages": [{"role": "user", "content": user_text}]},
+                **run_options
             ) as stream:
                 text_buffer = ''
+                run = None
+                # 1トークンごとではなく、時間窓・バイト数でまとめて送る
+                coalescer = DeltaCoalescer()
+                # 割り込みの確認は共有状態を読むので、差分ごとではなく時間窓に1回までにする
+                cancel_checked_at = None
                 for event in stream:
+                    if event.event == "thread.run.created":
+                        run = event.data
+                    now = time.monotonic()
+                    if cancel_checked_at is None or now - cancel_checked_at >= coalescer.window:
+                        cancel_checked_at = now
+                        if turn_cancelled(turn_id):
+                            # 割り込まれたターンは上流の run も止めて、残りの生成・合成をしない
+                            state.incr('bargein.cancelled_streams')
+                            if run is not None:
+                                assistant.cancel_run(run.thread_id, run.id)
+                            yield sse_event({'completed': True, 'cancelled': True})
+                            return
+                    if event.event != "thread.message.delta":
+                        # 差分以外のイベントでも、時間窓を過ぎたテキストは待たせずに送る
+                        text_event = coalescer.poll()
+                        if text_event:
+                            yield text_event
                     if event.event == "thread.message.delta" and event.data.delta.content:
                         text_chunk = event.data.delta.content[0].text.value
                         text_buffer += text_chunk
                         session['text_buffer'] += text_chunk
-                        yield f'data: {{"text": "{text_chunk}"}}\n\n'
+                        text_event = coalescer.add(text_chunk)
+                        if text_event:
+                            yield text_event
 
                         if '。' in text_buffer:
+                            # 音声合成で待たせる前に、溜まっているテキストを送っておく
+                            text_event = coalescer.flush()
+                            if text_event:
+                                yield text_event
                             sentences = assistant.split_text_for_tts(text_buffer)
+                            tts_started = time.perf_counter()
                             for sentence in sentences[:-1]:
-                                tts_response = assistant.text_to_speech(sentence)
-                                audio_base64 = base64.b64encode(tts_response.getvalue()).decode('utf-8')
-                                yield f'data: {{"audio": "{audio_base64}"}}\n\n'
+                                yield from synthesize(sentence)
+                            tts_seconds += time.perf_counter() - tts_started
                             text_buffer = sentences[-1]
 
                     elif event.event == "thread.run.completed":
+                        selector.observe(llm_model, time.perf_counter() - started - tts_seconds)
+                        text_event = coalescer.flush()
+                        if text_event:
+                            yield text_event
                         if text_buffer:
-                            tts_response = assistant.text_to_speech(text_buffer)
-                            audio_base64 = base64.b64encode(tts_response.getvalue()).decode('utf-8')
-                            yield f'data: {{"audio": "{audio_base64}"}}\n\n'
-                        yield f'data: {{"completed": true}}\n\n'
+                            yield from synthesize(text_buffer)
+                        yield sse_event({'completed': True, 'models': budget.models})
+                        if state.get('active_turn', sid) == turn_id:
+                            state.delete('active_turn', sid)
                         break
 
-        return Response(generate(), content_type='text/event-stream')
+        headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        if accepts_gzip(request):
+            headers['Content-Encoding'] = 'gzip'
+            return Response(gzip_stream(generate()), content_type='text/event-stream', headers=headers)
+        return Response(generate(), content_type='text/event-stream', headers=headers)
+
+def create_app():
+    app = Flask(__name__)
+    app.secret_key = os.getenv('SECRET_KEY', 'secret_key')
+    app.request_class = SpooledUploadRequest
+    app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
+    app.register_blueprint(bp)
+    # 画像の縮小版などを作る (変更が無ければ manifest を読むだけ)
+    # 書き込めない場所に置かれていても起動できるよう、失敗したら通常の static の URL で配信する
+    # (その場合はデプロイ時に python assets.py でビルドしておく)
+    try:
+        assets.build()
+    except (OSError, ValueError) as e:
+        app.logger.warning('asset build failed, serving plain static files: %s', e)
+    app.jinja_env.globals.update(asset_url=assets.url, asset_image=assets.image)
+    return app
+
+app = create_app()
 
 if __name__ == '__main__':
     if not os.path.exists('uploads'):
         os.makedirs('uploads')
+    # デバッグ時はリローダーの子プロセスがリクエストを受けるので、そちらで warm-up する
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        assistant.start_warm_up()
     app.run(debug=True)
@@ -0,0 +1,251 @@
+"""
+静的ファイルの配信用ビルド。
+
+    python assets.py            # static/build に書き出す (起動時にも古ければ自動で作り直す)
+
+- 画像は表示幅に合わせて縮小した AVIF/WebP と、非対応ブラウザ向けの JPEG/PNG を作る (Pillow がある場合)
+- 出力は中身のハッシュをファイル名に含めるので、長期間キャッシュさせても更新が反映される
+- css/js などのテキストは gzip (brotli があれば br も) に圧縮しておき、リクエストごとに圧縮しない
+"""
+import gzip
+import hashlib
+import importlib.util
+import io
+import json
+import mimetypes
+import os
+import tempfile
+
+from flask import send_from_directory, url_for
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+ASSET_BUILD_DIR = os.getenv('ASSET_BUILD_DIR', os.path.join(STATIC_DIR, 'build'))
+# 縮小版を作る画像と、その幅 (CSS 上の表示幅とその2倍)
+IMAGE_WIDTHS = {
+    'images/character.png': (600, 1200),
+}
+# 縮小版の形式と品質。対応している形式だけ作る
+IMAGE_FORMATS = (('avif', 'image/avif', 50), ('webp', 'image/webp', 80))
+# 事前に圧縮するテキストの拡張子
+COMPRESSIBLE_EXTENSIONS = ('.css', '.js', '.svg', '.json', '.txt', '.html')
+# ハッシュ付きの URL は中身が変われば変わるので、1年間キャッシュさせてよい
+CACHE_MAX_AGE = 365 * 24 * 3600
+# ビルド方法を変えたら上げる (古いビルドを作り直させる)
+BUILD_VERSION = 1
+
+
+def _digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _hashed_name(logical, data, ext=None, suffix=''):
+    stem, original_ext = os.path.splitext(logical)
+    return f'{stem}{suffix}.{_digest(data)[:12]}{ext or original_ext}'
+
+
+def _pillow_formats():
+    # Pillow は画像の縮小版を作るときだけ使う。無ければ元の画像をそのまま配信する
+    try:
+        from PIL import features
+    except ImportError:
+        return None
+    return [(ext, mime, quality) for ext, mime, quality in IMAGE_FORMATS if features.check(ext)]
+
+
+class AssetPipeline:
+    """
+    static 以下のファイルをハッシュ付きの名前で build ディレクトリに書き出し、manifest.json で引けるようにする。
+    """
+    def __init__(self, static_dir=STATIC_DIR, build_dir=ASSET_BUILD_DIR):
+        self.static_dir = os.path.abspath(static_dir)
+        self.build_dir = os.path.abspath(build_dir)
+        self.manifest = {'files': {}, 'images': {}, 'etags': {}}
+
+    def _sources(self):
+        for root, dirs, files in os.walk(self.static_dir):
+            dirs[:] = [d for d in dirs if os.path.join(root, d) != self.build_dir]
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                yield os.path.relpath(path, self.static_dir).replace(os.sep, '/'), path
+
+    def _fingerprint(self):
+        sources = {}
+        for logical, path in self._sources():
+            with open(path, 'rb') as f:
+                sources[logical] = _digest(f.read())
+        return {
+            'version': BUILD_VERSION,
+            'widths': {name: list(widths) for name, widths in IMAGE_WIDTHS.items()},
+            'sources': sources,
+        }
+
+    def _up_to_date(self, manifest, fingerprint):
+        built = manifest.get('fingerprint') or {}
+        if {key: built.get(key) for key in fingerprint} != fingerprint:
+            return False
+        # 起動を遅くしないよう Pillow は読み込まない。Pillow 無しで作ったビルドだけ、後から入ったかを確かめる
+        # (Pillow の更新で作れる形式が増えたときは python assets.py で作り直す)
+        return built.get('formats') is not None or importlib.util.find_spec('PIL') is None
+
+    def build(self, force=False):
+        """古ければ作り直し、manifest を読み込む。同じ中身なら何もしない。"""
+        manifest_path = os.path.join(self.build_dir, 'manifest.json')
+        fingerprint = self._fingerprint()
+        if not force and os.path.exists(manifest_path):
+            with open(manifest_path, encoding='utf-8') as f:
+                manifest = json.load(f)
+            if self._up_to_date(manifest, fingerprint):
+                self.manifest = manifest
+                return manifest
+
+        formats = _pillow_formats()
+        fingerprint['formats'] = None if formats is None else [ext for ext, _, _ in formats]
+        os.makedirs(self.build_dir, exist_ok=True)
+        manifest = {'fingerprint': fingerprint, 'files': {}, 'images': {}, 'etags': {}}
+        for logical, path in self._sources():
+            with open(path, 'rb') as f:
+                data = f.read()
+            manifest['files'][logical] = self._write(manifest, _hashed_name(logical, data), data)
+            if logical in IMAGE_WIDTHS and fingerprint['formats'] is not None:
+                image = self._build_image(manifest, logical, data)
+                if image:
+                    manifest['images'][logical] = image
+        # 複数のワーカーが同時に作っても壊れないよう、書き終えてから置き換える
+        fd, tmp_path = tempfile.mkstemp(dir=self.build_dir, suffix='.json')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=1)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, manifest_path)
+        self.manifest = manifest
+        return manifest
+
+    def _write(self, manifest, name, data):
+        path = os.path.join(self.build_dir, name)
+        manifest['etags'][name] = _digest(data)[:32]
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+            if name.endswith(COMPRESSIBLE_EXTENSIONS):
+                self._precompress(path, data)
+        return name
+
+    def _precompress(self, path, data):
+        with open(path + '.gz', 'wb') as f:
+            with gzip.GzipFile(fileobj=f, mode='wb', compresslevel=9, mtime=0) as gz:
+                gz.write(data)
+        try:
+            import brotli
+        except ImportError:
+            return
+        with open(path + '.br', 'wb') as f:
+            f.write(brotli.compress(data, quality=11))
+
+    def _build_image(self, manifest, logical, data):
+        from PIL import Image
+
+        with Image.open(io.BytesIO(data)) as original:
+            original.load()
+            # 透過が無ければ非対応ブラウザ向けには JPEG の方がずっと小さい
+            has_alpha = original.mode in ('RGBA', 'LA') or 'transparency' in original.info
+            fallback = ('png', '.png', 'image/png') if has_alpha else ('jpeg', '.jpg', 'image/jpeg')
+            widths = sorted({min(width, original.width) for width in IMAGE_WIDTHS[logical]})
+            height = round(original.height * widths[-1] / original.width)
+            image = {'width': widths[-1], 'height': height, 'sources': [], 'fallback': []}
+            for width in widths:
+                resized = original.resize((width, round(original.height * width / original.width)), Image.LANCZOS)
+                if not has_alpha and resized.mode != 'RGB':
+                    resized = resized.convert('RGB')
+                for ext, mime, quality in _pillow_formats():
+                    encoded = self._encode(resized, ext, quality=quality)
+                    name = self._write(manifest, _hashed_name(logical, encoded, f'.{ext}', f'-{width}'), encoded)
+                    self._add_source(image, mime, width, name)
+                options = {'optimize': True} if has_alpha else {'quality': 85, 'optimize': True, 'progressive': True}
+                encoded = self._encode(resized, fallback[0], **options)
+                name = self._write(manifest, _hashed_name(logical, encoded, fallback[1], f'-{width}'), encoded)
+                image['fallback'].append([width, name])
+            image['fallback_type'] = fallback[2]
+        return image
+
+    def _encode(self, image, format, **options):
+        buffer = io.BytesIO()
+        image.save(buffer, format=format.upper(), **options)
+        return buffer.getvalue()
+
+    def _add_source(self, image, mime, width, name):
+        for source in image['sources']:
+            if source['type'] == mime:
+                source['srcset'].append([width, name])
+                return
+        image['sources'].append({'type': mime, 'srcset': [[width, name]]})
+
+    # テンプレートから使うヘルパー
+    def url(self, logical):
+        """ハッシュ付きの URL。ビルドに無いファイルは通常の static の URL。"""
+        name = self.manifest['files'].get(logical)
+        if name is None:
+            return url_for('static', filename=logical)
+        return url_for('main.asset', filename=name)
+
+    def image(self, logical):
+        """
+        <picture> 用の情報 (sources: 形式ごとの srcset、src/srcset: 非対応ブラウザ向け、width/height)。
+        縮小版が無ければ元の画像だけを返す。
+        """
+        info = self.manifest['images'].get(logical)
+        if info is None:
+            return {'sources': [], 'src': self.url(logical), 'srcset': '', 'width': None, 'height': None}
+
+        def srcset(entries):
+            return ', '.join(f'{url_for("main.asset", filename=name)} {width}w' for width, name in entries)
+
+        return {
+            'sources': [{'type': source['type'], 'srcset': srcset(source['srcset'])} for source in info['sources']],
+            'src': url_for('main.asset', filename=info['fallback'][0][1]),
+            'srcset': srcset(info['fallback']),
+            'width': info['width'],
+            'height': info['height'],
+        }
+
+    def send(self, filename, accept_encoding=''):
+        """
+        ハッシュ付きのファイルを immutable なキャッシュ指定と ETag 付きで返す。
+        クライアントが対応していれば事前に圧縮したものを返す。
+        """
+        etag = self.manifest['etags'].get(filename)
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        encoding = None
+        for candidate, ext in (('br', '.br'), ('gzip', '.gz')):
+            if candidate in accept_encoding and os.path.exists(os.path.join(self.build_dir, filename + ext)):
+                encoding = candidate
+                break
+        path = filename + {'br': '.br', 'gzip': '.gz'}.get(encoding, '')
+        response = send_from_directory(
+            self.build_dir, path, mimetype=mimetype, max_age=CACHE_MAX_AGE,
+            etag=f'{etag}-{encoding}' if etag and encoding else (etag or True))
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+            # 圧縮済みファイルの名前 (.gz/.br) を見せない
+            response.headers.pop('Content-Disposition', None)
+        if filename.endswith(COMPRESSIBLE_EXTENSIONS):
+            response.vary.add('Accept-Encoding')
+        return response
+
+
+assets = AssetPipeline()
+
+
+if __name__ == '__main__':
+    manifest = assets.build(force=True)
+    for logical, name in sorted(manifest['files'].items()):
+        print(f'{logical} -> {name}')
+    for logical, image in sorted(manifest['images'].items()):
+        for source in image['sources'] + [{'type': image['fallback_type'], 'srcset': image['fallback']}]:
+            for width, name in source['srcset']:
+                size = os.path.getsize(os.path.join(assets.build_dir, name))
+                print(f'{logical} {source["type"]} {width}w -> {name} ({size / 1024:.0f} KiB)')
@@ -0,0 +1,295 @@
+import struct
+
+# デコード・再エンコードせずに連結できる形式
+# flac はフレームにストリーム先頭からの番号が入っているので連結しない
+CONCATENABLE_FORMATS = ('mp3', 'aac', 'pcm', 'wav', 'opus')
+
+
+def concat_audio(parts, response_format):
+    """
+    別々に合成した音声を1つの音声データにつなぐ。
+
+    mp3/aac はフレーム、pcm はサンプルをそのまま並べ、wav はヘッダを付け直し、
+    opus は Ogg のページを1本のストリームに組み直す。
+    """
+    if response_format not in CONCATENABLE_FORMATS:
+        raise ValueError(f'cannot concatenate {response_format} audio')
+    if len(parts) == 1:
+        return parts[0]
+    if response_format == 'wav':
+        return _concat_wav(parts)
+    if response_format == 'opus':
+        return _concat_ogg(parts)
+    if response_format == 'mp3':
+        return _concat_mp3(parts)
+    return b''.join(parts)
+
+
+# MPEG オーディオのビットレート (kbps)。[MPEG-1 か][ビットレート番号]、Layer III のみ
+_MP3_BITRATES = {
+    True: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    False: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+_MP3_SAMPLERATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+
+def _concat_mp3(parts):
+    """
+    MPEG フレームを並べてつなぐ。
+
+    途中のパートの ID3v2 (先頭) と ID3v1 (末尾) のタグ、VBR 情報 (Xing/Info) のフレームは外す。
+    先頭パートの Xing/Info にはそのパートだけのフレーム数が書かれていて、デコーダがそこで止まるので
+    全体のフレーム数とバイト数に書き換える。
+    エンコーダの遅延と末尾の詰め物はストリームの先頭と末尾でしか取り除かれないので、
+    つなぎ目ごとに数フレームぶんの無音に近い音が入る。
+    """
+    frames = []
+    info = None
+    for index, part in enumerate(parts):
+        tag = _id3v2_length(part)
+        if index == 0:
+            head, part = part[:tag], part[tag:]
+        else:
+            part = part[tag:]
+        if index < len(parts) - 1 and len(part) >= 128 and part[-128:-125] == b'TAG':
+            part = part[:-128]
+        length = _mp3_frame_length(part[:4])
+        if length and any(marker in part[:length] for marker in (b'Xing', b'Info', b'VBRI')):
+            if index == 0:
+                info = bytearray(part[:length])
+            part = part[length:]
+        frames.append(part)
+    audio = b''.join(frames)
+    if info is not None:
+        info = _rewrite_xing(info, _mp3_frame_count(audio), len(info) + len(audio))
+    return head + (info or b'') + audio
+
+
+def _rewrite_xing(frame, frame_count, byte_count):
+    # Xing/Info ヘッダのフレーム数・バイト数を書き換える。VBRI は書き換えられないので外す
+    position = max(frame.find(b'Xing'), frame.find(b'Info'))
+    if position < 0:
+        return None
+    flags, = struct.unpack_from('>I', frame, position + 4)
+    offset = position + 8
+    if flags & 0x01:
+        struct.pack_into('>I', frame, offset, frame_count)
+        offset += 4
+    if flags & 0x02:
+        struct.pack_into('>I', frame, offset, byte_count)
+    return bytes(frame)
+
+
+def _mp3_frame_count(data):
+    count = 0
+    position = 0
+    while position < len(data):
+        length = _mp3_frame_length(data[position:position + 4])
+        if not length:
+            break
+        count += 1
+        position += length
+    return count
+
+
+def _id3v2_length(data):
+    if data[:3] != b'ID3' or len(data) < 10:
+        return 0
+    size = 0
+    for byte in data[6:10]:
+        size = (size << 7) | (byte & 0x7f)
+    return 10 + size + (10 if data[5] & 0x10 else 0)
+
+
+def _mp3_frame_length(header):
+    # Layer III のフレームヘッダからフレームのバイト数を求める。ヘッダでなければ None
+    if len(header) < 4 or header[0] != 0xff or header[1] & 0xe0 != 0xe0 or (header[1] >> 1) & 0x03 != 1:
+        return None
+    version = (header[1] >> 3) & 0x03
+    bitrate_index = header[2] >> 4
+    samplerate_index = (header[2] >> 2) & 0x03
+    if version == 1 or bitrate_index in (0, 15) or samplerate_index == 3:
+        return None
+    mpeg1 = version == 3
+    bitrate = _MP3_BITRATES[mpeg1][bitrate_index] * 1000
+    samplerate = _MP3_SAMPLERATES[version][samplerate_index]
+    padding = (header[2] >> 1) & 0x01
+    return (144 if mpeg1 else 72) * bitrate // samplerate + padding
+
+
+def _wav_chunks(data):
+    # RIFF ヘッダの後ろのチャンクを (ID, 中身) で返す
+    # ストリーミング出力ではサイズが 0xFFFFFFFF のことがあるので、その場合は末尾までとみなす
+    if data[:4] != b'RIFF' or data[8:12] != b'WAVE':
+        raise ValueError('not a RIFF/WAVE stream')
+    offset = 12
+    while offset + 8 <= len(data):
+        chunk_id, size = struct.unpack_from('<4sI', data, offset)
+        body = data[offset + 8:offset + 8 + size]
+        yield chunk_id, body
+        offset += 8 + size + (size & 1)
+
+
+def _concat_wav(parts):
+    fmt = None
+    samples = []
+    for part in parts:
+        for chunk_id, body in _wav_chunks(part):
+            if chunk_id == b'fmt ':
+                if fmt is None:
+                    fmt = body
+                elif body != fmt:
+                    raise ValueError('wav parts have different formats')
+            elif chunk_id == b'data':
+                samples.append(body)
+    if fmt is None:
+        raise ValueError('wav part has no fmt chunk')
+    data = b''.join(samples)
+    return b''.join([
+        b'RIFF', struct.pack('<I', 4 + 8 + len(fmt) + (len(fmt) & 1) + 8 + len(data) + (len(data) & 1)), b'WAVE',
+        b'fmt ', struct.pack('<I', len(fmt)), fmt, b'\0' * (len(fmt) & 1),
+        b'data', struct.pack('<I', len(data)), data, b'\0' * (len(data) & 1),
+    ])
+
+
+# Ogg のページ
+_OGG_HEADER = struct.Struct('<4sBBqIII')
+_OGG_BOS = 0x02
+_OGG_EOS = 0x04
+# Opus の先頭2パケット (OpusHead, OpusTags) はヘッダ
+_OPUS_HEADER_PACKETS = 2
+
+
+def _ogg_crc_table():
+    table = []
+    for i in range(256):
+        crc = i << 24
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x04c11db7) if crc & 0x80000000 else crc << 1
+        table.append(crc & 0xffffffff)
+    return table
+
+
+_OGG_CRC_TABLE = _ogg_crc_table()
+
+
+def _ogg_crc(page):
+    crc = 0
+    table = _OGG_CRC_TABLE
+    for byte in page:
+        crc = ((crc << 8) & 0xffffffff) ^ table[(crc >> 24) ^ byte]
+    return crc
+
+
+def _ogg_pages(data):
+    # (フラグ, グラニュール位置, シリアル番号, セグメントテーブル, 中身) を順に返す
+    offset = 0
+    while offset < len(data):
+        capture, version, flags, granule, serial, sequence, crc, segments = (
+            *_OGG_HEADER.unpack_from(data, offset), data[offset + _OGG_HEADER.size])
+        if capture != b'OggS':
+            raise ValueError('not an Ogg stream')
+        lacing = data[offset + _OGG_HEADER.size + 1:offset + _OGG_HEADER.size + 1 + segments]
+        body_start = offset + _OGG_HEADER.size + 1 + segments
+        body_end = body_start + sum(lacing)
+        yield flags, granule, serial, lacing, data[body_start:body_end]
+        offset = body_end
+
+
+def _ogg_page(flags, granule, serial, sequence, lacing, body):
+    header = _OGG_HEADER.pack(b'OggS', 0, flags, granule, serial, sequence, 0) + bytes([len(lacing)]) + lacing
+    page = bytearray(header + body)
+    struct.pack_into('<I', page, 22, _ogg_crc(page))
+    return bytes(page)
+
+
+def _opus_packet_samples(packet):
+    """Opus パケットの TOC バイトから、48kHz でのサンプル数を求める。"""
+    if not packet:
+        return 0
+    config = packet[0] >> 3
+    if config < 12:
+        frame = (480, 960, 1920, 2880)[config % 4]
+    elif config < 16:
+        frame = (480, 960)[config % 2]
+    else:
+        frame = (120, 240, 480, 960)[config % 4]
+    code = packet[0] & 0x03
+    if code == 0:
+        frames = 1
+    elif code in (1, 2):
+        frames = 2
+    else:
+        frames = packet[1] & 0x3f if len(packet) > 1 else 0
+    return frame * frames
+
+
+def _opus_pages(data):
+    """
+    Ogg Opus のページごとに (フラグ, グラニュール位置, シリアル番号, セグメントテーブル, 中身,
+    ヘッダのページか, そのページまでに終わったパケットのサンプル数の合計 (終わらなければ None)) を返す。
+    """
+    packets = 0
+    packet = b''
+    samples = 0
+    for flags, granule, serial, lacing, body in _ogg_pages(data):
+        header = packets < _OPUS_HEADER_PACKETS
+        completed = False
+        offset = 0
+        for value in lacing:
+            packet += body[offset:offset + value]
+            offset += value
+            if value < 255:
+                if packets >= _OPUS_HEADER_PACKETS:
+                    samples += _opus_packet_samples(packet)
+                packets += 1
+                packet = b''
+                completed = True
+        yield flags, granule, serial, lacing, body, header, samples if completed else None
+
+
+def _concat_ogg(parts):
+    """
+    Ogg Opus を1本の論理ストリームに組み直す。
+
+    2つ目以降のパートはヘッダのページを捨て、シリアル番号・ページ番号・グラニュール位置を
+    前のパートの続きに書き換える。パケットはそのまま使うので再エンコードはしない。
+    末尾の切り詰め (グラニュール位置がデコードされるサンプル数より小さい) は最後のページにしか
+    許されないので、グラニュール位置はパケットの長さから数え直し、最後のページだけ元の値を使う。
+
+    Ogg Opus では途中から切り詰められないので、つなぎ目ごとに前のパートの末尾の詰め物と
+    次のパートの先頭のウォームアップ (OpusHead の pre-skip) がそのまま再生される
+    (合わせて最大 1 パケット + pre-skip、20ms のパケットなら 30ms 弱の無音に近い音)。
+    """
+    output = []
+    serial = None
+    sequence = 0
+    offset = 0
+    for index, part in enumerate(parts):
+        pages = list(_opus_pages(part))
+        part_samples = 0
+        for page_index, (flags, granule, page_serial, lacing, body, header, samples) in enumerate(pages):
+            if samples is not None:
+                part_samples = samples
+            if header and index > 0:
+                continue
+            if serial is None:
+                serial = page_serial
+            final = index == len(parts) - 1 and page_index == len(pages) - 1
+            flags &= ~(_OGG_BOS | _OGG_EOS)
+            if index == 0 and page_index == 0:
+                flags |= _OGG_BOS
+            if final:
+                flags |= _OGG_EOS
+            elif header:
+                granule = 0
+            elif samples is None:
+                granule = -1
+            else:
+                granule = offset + samples
+            if final and granule != -1:
+                granule += offset
+            output.append(_ogg_page(flags, granule, serial, sequence, lacing, body))
+            sequence += 1
+        offset += part_samples
+    return b''.join(output)
@@ -0,0 +1,35 @@
+import os
+
+# 音声合成 API の出力形式と、ブラウザに返す MIME タイプ
+# pcm は 24kHz / 16bit / モノラルのヘッダなし生データ
+TTS_MIME_TYPES = {
+    'opus': 'audio/ogg; codecs=opus',
+    'aac': 'audio/aac',
+    'mp3': 'audio/mpeg',
+    'pcm': 'audio/L16; rate=24000; channels=1',
+    'wav': 'audio/wav',
+    'flac': 'audio/flac',
+}
+TTS_FILE_EXTENSIONS = {
+    'opus': '.ogg',
+    'aac': '.aac',
+    'mp3': '.mp3',
+    'pcm': '.pcm',
+    'wav': '.wav',
+    'flac': '.flac',
+}
+# 帯域を抑えるため既定は opus
+DEFAULT_TTS_FORMAT = os.getenv('TTS_FORMAT', 'opus')
+
+
+def negotiate_tts_format(requested):
+    """リクエストで指定された形式を検証して返す。未指定なら既定値。"""
+    if requested is None or requested == '':
+        return DEFAULT_TTS_FORMAT
+    # JSON では数値なども送れるので、文字列以外は形式名として扱わない
+    if not isinstance(requested, str):
+        raise ValueError(f'Unsupported audio format: {requested!r}')
+    requested = requested.lower()
+    if requested not in TTS_MIME_TYPES:
+        raise ValueError(f'Unsupported audio format: {requested}')
+    return requested
@@ -0,0 +1,242 @@
+"""
+録音済み面談音声をまとめてオフライン処理するバッチ CLI。
+
+    python batch.py recordings/ -o out/ -c 4
+    python batch.py manifest.jsonl -o out/ --resume
+
+入力はディレクトリ (音声ファイルを再帰的に列挙) または JSONL マニフェスト
+(1行1件、{"id": ..., "path": ...})。結果は out/results.jsonl と out/audio/ に
+逐次書き出し、out/checkpoint.json で途中再開できる。失敗した件は再開時にやり直すので、
+results.jsonl に同じ index が複数あれば後の行が最新の結果。
+"""
+import argparse
+import concurrent.futures
+import json
+import os
+import sys
+import time
+
+from audio_formats import DEFAULT_TTS_FORMAT, TTS_FILE_EXTENSIONS
+from metrics import LatencyHistogram
+
+AUDIO_EXTENSIONS = ('.wav', '.flac', '.ogg', '.mp3', '.webm', '.m4a')
+
+
+def iter_directory(root):
+    # ディレクトリ単位でソートしながら辿るので、全件をメモリに載せずに順序が決まる
+    for name in sorted(os.listdir(root)):
+        path = os.path.join(root, name)
+        if os.path.isdir(path):
+            yield from iter_directory(path)
+        elif name.lower().endswith(AUDIO_EXTENSIONS):
+            yield os.path.relpath(path, root), path
+
+
+def iter_manifest(manifest_path):
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    with open(manifest_path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line)
+            path = entry['path']
+            if not os.path.isabs(path):
+                path = os.path.join(base_dir, path)
+            yield str(entry.get('id', entry['path'])), path
+
+
+def iter_items(source):
+    if os.path.isdir(source):
+        items = iter_directory(source)
+    else:
+        items = iter_manifest(source)
+    for index, (item_id, path) in enumerate(items):
+        yield index, item_id, path
+
+
+class Checkpoint:
+    """
+    処理済み位置を記録する。
+
+    next_index 未満は全て完了済み、done_above はそれ以降で先に完了したもの。
+    並列度ぶんしか done_above に溜まらないので、件数が増えてもサイズは一定。
+    failed は失敗したもの。レート制限やタイムアウトなど一時的な失敗もあるので、再開時にやり直す。
+    """
+    def __init__(self, path, source):
+        self.path = path
+        self.source = os.path.abspath(source)
+        self.next_index = 0
+        self.done_above = set()
+        self.failed = set()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, encoding='utf-8') as f:
+            state = json.load(f)
+        if state.get('source') != self.source:
+            raise SystemExit(f'checkpoint {self.path} belongs to {state.get("source")}, not {self.source}')
+        self.next_index = state['next_index']
+        self.done_above = set(state['done_above'])
+        self.failed = set(state.get('failed', ()))
+
+    def is_done(self, index):
+        return (index < self.next_index or index in self.done_above) and index not in self.failed
+
+    def mark_done(self, index, failed=False):
+        if failed:
+            self.failed.add(index)
+        else:
+            self.failed.discard(index)
+        if index < self.next_index:
+            # 再開時にやり直した失敗分
+            return
+        self.done_above.add(index)
+        while self.next_index in self.done_above:
+            self.done_above.remove(self.next_index)
+            self.next_index += 1
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                'source': self.source,
+                'next_index': self.next_index,
+                'done_above': sorted(self.done_above),
+                'failed': sorted(self.failed),
+            }, f)
+        os.replace(tmp_path, self.path)
+
+
+class BatchRunner:
+    def __init__(self, assistant, out_dir, concurrency=4, skip_tts=False, audio_format=DEFAULT_TTS_FORMAT):
+        self.assistant = assistant
+        self.out_dir = out_dir
+        self.audio_dir = os.path.join(out_dir, 'audio')
+        self.concurrency = concurrency
+        self.skip_tts = skip_tts
+        self.audio_format = audio_format
+        self.latency = {stage: LatencyHistogram() for stage in ('stt', 'llm', 'tts', 'total')}
+        os.makedirs(self.audio_dir, exist_ok=True)
+
+    def process_item(self, index, item_id, path):
+        started = time.perf_counter()
+        timings = {}
+
+        with open(path, 'rb') as audio_stream:
+            user_text = self.assistant.transcribe_audio(audio_stream)
+        timings['stt'] = time.perf_counter() - started
+
+        # 面談ごとに独立して評価したいので、1件ごとに新しいスレッドで応答させる
+        stage_started = time.perf_counter()
+        thread_id = self.assistant.client.beta.threads.create().id
+        assistant_text = self.assistant.run_thread_actions(user_text, thread_id=thread_id)
+        timings['llm'] = time.perf_counter() - stage_started
+
+        audio_path = None
+        if not self.skip_tts and assistant_text:
+            stage_started = time.perf_counter()
+            audio_stream = self.assistant.text_to_speech(assistant_text, self.audio_format)
+            audio_path = os.path.join(self.audio_dir, f'{index:08d}{TTS_FILE_EXTENSIONS[self.audio_format]}')
+            with open(audio_path, 'wb') as f:
+                f.write(audio_stream.getbuffer())
+            timings['tts'] = time.perf_counter() - stage_started
+
+        timings['total'] = time.perf_counter() - started
+        return {
+            'index': index,
+            'id': item_id,
+            'path': path,
+            'user': user_text,
+            'assistant': assistant_text,
+            'audio': os.path.relpath(audio_path, self.out_dir) if audio_path else None,
+            'timings': {stage: round(seconds, 4) for stage, seconds in timings.items()},
+        }
+
+    def run(self, source, resume=False, limit=None):
+        checkpoint = Checkpoint(os.path.join(self.out_dir, 'checkpoint.json'), source)
+        if resume:
+            checkpoint.load()
+
+        results_path = os.path.join(self.out_dir, 'results.jsonl')
+        processed = 0
+        failed = 0
+        started = time.perf_counter()
+        # 先読みは並列度の2倍までに抑え、入力の大きさによらずメモリを一定に保つ
+        max_pending = self.concurrency * 2
+
+        with open(results_path, 'a', encoding='utf-8') as results, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            pending = {}
+
+            def drain(return_when):
+                nonlocal processed, failed
+                done, _ = concurrent.futures.wait(pending, return_when=return_when)
+                for future in done:
+                    index, item_id, path = pending.pop(future)
+                    try:
+                        record = future.result()
+                    except Exception as e:
+                        failed += 1
+                        record = {'index': index, 'id': item_id, 'path': path, 'error': repr(e)}
+                    else:
+                        processed += 1
+                        for stage, seconds in record['timings'].items():
+                            self.latency[stage].record(seconds)
+                    results.write(json.dumps(record, ensure_ascii=False) + '\n')
+                    results.flush()
+                    checkpoint.mark_done(index, failed='error' in record)
+                checkpoint.save()
+
+            for index, item_id, path in iter_items(source):
+                if limit is not None and index >= limit:
+                    break
+                if checkpoint.is_done(index):
+                    continue
+                future = executor.submit(self.process_item, index, item_id, path)
+                pending[future] = (index, item_id, path)
+                if len(pending) >= max_pending:
+                    drain(concurrent.futures.FIRST_COMPLETED)
+
+            while pending:
+                drain(concurrent.futures.FIRST_COMPLETED)
+
+        elapsed = time.perf_counter() - started
+        return {
+            'processed': processed,
+            'failed': failed,
+            'elapsed': round(elapsed, 3),
+            'throughput_per_min': round(processed / elapsed * 60, 2) if elapsed else 0.0,
+            'latency': {stage: histogram.summary() for stage, histogram in self.latency.items()},
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='面談音声のバッチ文字起こし・応答生成')
+    parser.add_argument('source', help='音声ディレクトリ または JSONL マニフェスト')
+    parser.add_argument('-o', '--out', required=True, help='出力ディレクトリ')
+    parser.add_argument('-c', '--concurrency', type=int, default=4, help='同時処理数')
+    parser.add_argument('--resume', action='store_true', help='checkpoint.json から再開する')
+    parser.add_argument('--limit', type=int, default=None, help='先頭から処理する最大件数')
+    parser.add_argument('--skip-tts', action='store_true', help='応答音声を生成しない')
+    parser.add_argument('--format', default=DEFAULT_TTS_FORMAT, choices=sorted(TTS_FILE_EXTENSIONS), help='応答音声の形式')
+    args = parser.parse_args(argv)
+
+    from app import AIAssistant, ASSISTANT_ID, API_KEY
+
+    os.makedirs(args.out, exist_ok=True)
+    runner = BatchRunner(
+        AIAssistant(assistant_id=ASSISTANT_ID, api_key=API_KEY),
+        args.out,
+        concurrency=args.concurrency,
+        skip_tts=args.skip_tts,
+        audio_format=args.format,
+    )
+    report = runner.run(args.source, resume=args.resume, limit=args.limit)
+    json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+スタブのテールレイテンシ注入を使って、ヘッジの有無で文字起こし・音声合成の p99 を比べる。
+
+まれに STUB_TAIL_LATENCY 秒遅くなる上流に対し、ヘッジなし → ヘッジありの順に同じ回数呼び出し、
+パーセンタイルとヘッジの発火・勝利回数を表示する。
+
+    python bench/hedging.py --calls 300 --tail-prob 0.03 --tail-latency 1.0
+"""
+import argparse
+import concurrent.futures
+import io
+import os
+import sys
+import tempfile
+
+os.environ['OPENAI_BACKEND'] = 'stub'
+os.environ.setdefault('SHARED_STATE_PATH', os.path.join(tempfile.mkdtemp(), 'state.sqlite3'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import time  # noqa: E402
+
+from app import assistant  # noqa: E402
+from hedging import hedger  # noqa: E402
+from metrics import LatencyHistogram  # noqa: E402
+from shared_state import state  # noqa: E402
+
+ANSWER = 'ご質問ありがとうございます。'
+
+
+def recording():
+    return io.BytesIO(assistant.client.synthesize('あ' * 20, 'wav'))
+
+
+def call(stage):
+    started = time.perf_counter()
+    if stage == 'stt':
+        assistant.transcribe_audio(recording(), 'recording.wav')
+    elif stage == 'tts':
+        assistant.text_to_speech(ANSWER, 'wav')
+    else:
+        for _ in assistant.text_to_speech_stream(ANSWER, 'wav'):
+            break
+    return time.perf_counter() - started
+
+
+def run_phase(stage, calls, concurrency):
+    histogram = LatencyHistogram()
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as pool:
+        for elapsed in pool.map(lambda _: call(stage), range(calls)):
+            histogram.record(elapsed)
+    return histogram.summary()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--calls', type=int, default=300)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.05, help='通常時の上流レイテンシ (秒)')
+    parser.add_argument('--tail-prob', type=float, default=0.03)
+    parser.add_argument('--tail-latency', type=float, default=1.0)
+    args = parser.parse_args()
+
+    stub = assistant.client
+    stub.latency_stt = stub.latency_tts = args.latency
+    stub.latency_tts_char = 0.0
+    stub.tail_prob = args.tail_prob
+    stub.tail_latency = args.tail_latency
+
+    # 'tts_stream' は最初のチャンクまでの時間
+    for stage in ('stt', 'tts', 'tts_stream'):
+        hedge_stage = 'tts' if stage == 'tts_stream' else stage
+        hedger.stages = set()
+        off = run_phase(stage, args.calls, args.concurrency)
+        hedger.stages = {hedge_stage}
+        before = state.counters(f'hedge.{hedge_stage}.')
+        on = run_phase(stage, args.calls, args.concurrency)
+        after = state.counters(f'hedge.{hedge_stage}.')
+        counts = {name.rsplit('.', 1)[1]: after.get(name, 0) - before.get(name, 0) for name in after}
+        print(f'--- {stage}')
+        for name, summary in (('no hedge', off), ('hedged', on)):
+            print(f'{name:<9} p50 {summary["p50"] * 1000:6.0f} ms  p95 {summary["p95"] * 1000:6.0f} ms  '
+                  f'p99 {summary["p99"] * 1000:6.0f} ms  max {summary["max"] * 1000:6.0f} ms')
+        print(f'hedges    {counts} / {args.calls} calls')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+スタブのレイテンシ注入を使って、予算に応じたモデル選択の動きを確かめる。
+
+tts-1-hd を途中で遅くし、予算内に収まる tts-1 に切り替わること、
+回復後は MODEL_PROBE_INTERVAL ごとの試し直しで tts-1-hd に戻ることを表示する。
+
+    python bench/model_selection.py --turns 10 --budget-ms 3000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+os.environ['OPENAI_BACKEND'] = 'stub'
+os.environ.setdefault('SHARED_STATE_PATH', os.path.join(tempfile.mkdtemp(), 'state.sqlite3'))
+os.environ.setdefault('STUB_LATENCY_LLM', '0.2')
+os.environ.setdefault('STUB_LATENCY_STT', '0.1')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from app import assistant  # noqa: E402
+from model_selector import TurnBudget, selector  # noqa: E402
+
+ANSWER = 'ご質問ありがとうございます。私はこれまでバックエンド開発を中心に担当してきました。'
+
+
+def run_turn(budget_seconds):
+    budget = TurnBudget(time.time() + budget_seconds, stages=('tts',))
+    started = time.perf_counter()
+    assistant.text_to_speech(ANSWER, 'wav', budget)
+    return budget.models['tts'], time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--turns', type=int, default=8)
+    parser.add_argument('--budget-ms', type=float, default=1500)
+    parser.add_argument('--probe-interval', type=float, default=2.0)
+    args = parser.parse_args()
+
+    selector.probe_interval = args.probe_interval
+    stub = assistant.client
+    stub.latency_tts_char = 0.0
+    phases = [
+        ('hd fast', {'tts-1-hd': 0.4, 'tts-1': 0.2}),
+        ('hd slow', {'tts-1-hd': 2.5, 'tts-1': 0.2}),
+        ('hd recovered', {'tts-1-hd': 0.4, 'tts-1': 0.2}),
+    ]
+    for name, latencies in phases:
+        stub.model_latency = latencies
+        print(f'--- {name}: {latencies}')
+        for turn in range(args.turns):
+            model, elapsed = run_turn(args.budget_ms / 1000.0)
+            within = 'ok' if elapsed * 1000 <= args.budget_ms else 'over budget'
+            print(f'turn {turn:2d}  {model:<9} {elapsed * 1000:7.0f} ms  {within}')
+            if name == 'hd recovered':
+                time.sleep(args.probe_interval / 2)
+    print('ewma seconds/char:', selector.tracker.snapshot())
+
+
+if __name__ == '__main__':
+    main()
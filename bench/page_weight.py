@@ -0,0 +1,56 @@
+"""
+面談ページの初回表示で転送されるバイト数を、ブラウザの対応形式ごとに数える。
+
+index.html が参照する css と画像を Accept / Accept-Encoding を付けて取得し、
+元の static の character.png と style.css を配信していたときと比べる。
+2回目の読み込みは ETag で 304 になるか (ハッシュ付き URL ならそもそもリクエストしない) も確かめる。
+
+    python bench/page_weight.py
+"""
+import base64
+import os
+import re
+import sys
+import tempfile
+
+os.environ['OPENAI_BACKEND'] = 'stub'
+os.environ.setdefault('SHARED_STATE_PATH', os.path.join(tempfile.mkdtemp(), 'state.sqlite3'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from app import app, USERNAME, PASSWORD  # noqa: E402
+
+BROWSERS = {
+    'avif': 'image/avif,image/webp,*/*',
+    'webp': 'image/webp,*/*',
+    'legacy': '*/*',
+}
+
+
+def pick_image(html, accept):
+    # ブラウザと同じく、対応している最初の <source> の 1200w (高解像度画面) を選ぶ
+    for mime, srcset in re.findall(r'<source type="([^"]+)" srcset="([^"]+)"', html):
+        if mime in accept:
+            return srcset.split(', ')[-1].split()[0]
+    return re.search(r'<img src="[^"]+" srcset="([^"]+)"', html).group(1).split(', ')[-1].split()[0]
+
+
+def main():
+    client = app.test_client()
+    auth = {'Authorization': 'Basic ' + base64.b64encode(f'{USERNAME}:{PASSWORD}'.encode()).decode()}
+    html = client.get('/', headers=auth).get_data(as_text=True)
+    css = re.search(r'<link rel="stylesheet" href="([^"]+)"', html).group(1)
+
+    before = sum(len(client.get(f'/static/{name}').data) for name in ('images/character.png', 'style.css'))
+    print(f'{"before":<8} {before / 1024:8.1f} KiB  (character.png + style.css)')
+    for name, accept in BROWSERS.items():
+        image = pick_image(html, accept)
+        css_response = client.get(css, headers={'Accept-Encoding': 'gzip, deflate, br'})
+        image_response = client.get(image, headers={'Accept': accept})
+        total = len(css_response.data) + len(image_response.data)
+        revalidated = client.get(image, headers={'If-None-Match': image_response.headers['ETag']}).status_code
+        print(f'{name:<8} {total / 1024:8.1f} KiB  ({os.path.basename(image)}, css {css_response.headers.get("Content-Encoding")})'
+              f'  cache: {image_response.headers["Cache-Control"]}, revalidate -> {revalidated}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""
+長い文章の音声合成について、1回の呼び出しと文の区切りで分けた並列合成の所要時間を比べる。
+
+スタブの音声合成は固定レイテンシ + 1文字あたりのレイテンシなので、入力の長さごとに
+壁時計時間の短縮率と、つなぐ処理 (デコード・再エンコードなし) にかかった時間を表示する。
+本物の API ではエンコードは上流で行われるので、スタブがローカルでエンコードする時間は
+キャッシュして計測から除く。
+
+    python bench/parallel_tts.py --format opus --lengths 100,200,400,800,1600,3200
+"""
+import argparse
+import functools
+import os
+import sys
+import tempfile
+import time
+
+os.environ['OPENAI_BACKEND'] = 'stub'
+os.environ.setdefault('SHARED_STATE_PATH', os.path.join(tempfile.mkdtemp(), 'state.sqlite3'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from app import assistant, TTS_PARALLEL_WORKERS  # noqa: E402
+from audio_concat import concat_audio  # noqa: E402
+
+SENTENCE = 'ご質問ありがとうございます。私はこれまでバックエンド開発を中心に担当してきました。'
+
+
+def long_text(chars):
+    return (SENTENCE * (chars // len(SENTENCE) + 1))[:chars]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--format', default='opus')
+    parser.add_argument('--lengths', default='100,200,400,800,1600,3200')
+    parser.add_argument('--repeat', type=int, default=1)
+    args = parser.parse_args()
+
+    stub = assistant.client
+    stub.synthesize = functools.lru_cache(maxsize=None)(stub.synthesize)
+
+    print(f'format {args.format}, workers {TTS_PARALLEL_WORKERS}')
+    print(f'{"chars":>6} {"parts":>5} {"single":>9} {"parallel":>9} {"speedup":>8} {"concat":>9}')
+    for chars in map(int, args.lengths.split(',')):
+        text = long_text(chars)
+        model = assistant.tts_model
+        parts = assistant.split_text_for_parallel_tts(text)
+        for part in [text, *parts]:
+            stub.synthesize(part, args.format)
+        single = parallel = concat = float('inf')
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            assistant._speech_content(model, text, args.format)
+            single = min(single, time.perf_counter() - started)
+
+            started = time.perf_counter()
+            assistant.text_to_speech(text, args.format)
+            parallel = min(parallel, time.perf_counter() - started)
+
+            contents = [assistant._speech_content(model, part, args.format) for part in parts]
+            started = time.perf_counter()
+            concat_audio(contents, args.format)
+            concat = min(concat, time.perf_counter() - started)
+        print(f'{chars:6d} {len(parts):5d} {single * 1000:7.0f}ms {parallel * 1000:7.0f}ms '
+              f'{single / parallel:7.2f}x {concat * 1000:7.1f}ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""
+SSE のテキスト配信について、1トークン1イベント (旧方式) とまとめて送る方式を比べる。
+
+トークンは --interval-ms 間隔で届くものとし、時計を進めながらフレーミングだけを実行する。
+各チャンクは WSGI サーバーと同様に1回ずつ書き込み (/dev/null への write) まで行うので、
+計測される CPU 時間はフレーミング・圧縮・書き込みのシステムコールを合わせたもの。
+
+    python bench/sse_framing.py --chars 400 --interval-ms 20 --iterations 200
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from sse import DeltaCoalescer, SSE_COALESCE_MS, gzip_stream, sse_event  # noqa: E402
+
+ANSWER = (
+    'ご質問ありがとうございます。私はこれまで「バックエンド開発」を中心に担当してきました。'
+    '直近ではチームのリーダーとして設計とレビューを行い、障害対応の仕組みづくりにも取り組んでいます。\n'
+)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def legacy_events(deltas, clock, interval):
+    for delta in deltas:
+        clock.now += interval
+        yield f'data: {{"text": "{delta}"}}\n\n'
+
+
+def per_delta_events(deltas, clock, interval):
+    # 1トークン1イベントのまま JSON として正しくエスケープした場合
+    for delta in deltas:
+        clock.now += interval
+        yield sse_event({'text': delta})
+
+
+def coalesced_events(deltas, clock, interval, window_ms):
+    coalescer = DeltaCoalescer(window_ms=window_ms, clock=clock)
+    for delta in deltas:
+        clock.now += interval
+        event = coalescer.add(delta)
+        if event:
+            yield event
+    event = coalescer.flush()
+    if event:
+        yield event
+
+
+def measure(label, make_events, iterations, compress=False):
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    started = time.process_time()
+    for _ in range(iterations):
+        events = make_events()
+        chunks = []
+        for chunk in (gzip_stream(events) if compress else events):
+            os.write(devnull, chunk if isinstance(chunk, bytes) else chunk.encode('utf-8'))
+            chunks.append(chunk)
+    os.close(devnull)
+    cpu = (time.process_time() - started) / iterations
+    size = sum(len(c.encode('utf-8')) if isinstance(c, str) else len(c) for c in chunks)
+    writes = len(chunks) - (1 if compress else 0)
+    print(f'{label:<28} writes/answer {writes:5d}  bytes {size:7d}  cpu/stream {cpu * 1e6:8.1f} us')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chars', type=int, default=400)
+    parser.add_argument('--interval-ms', type=float, default=20)
+    parser.add_argument('--window-ms', type=float, default=SSE_COALESCE_MS)
+    parser.add_argument('--iterations', type=int, default=200)
+    args = parser.parse_args()
+
+    text = (ANSWER * (args.chars // len(ANSWER) + 1))[:args.chars]
+    deltas = list(text)  # 日本語では1文字ずつ届くことが多い
+    interval = args.interval_ms / 1000.0
+    print(f'{len(deltas)} deltas, {args.interval_ms} ms apart, window {args.window_ms} ms')
+
+    measure('legacy (1 event / delta)', lambda: legacy_events(deltas, FakeClock(), interval), args.iterations)
+    measure('per delta (escaped)', lambda: per_delta_events(deltas, FakeClock(), interval), args.iterations)
+    measure('coalesced', lambda: coalesced_events(deltas, FakeClock(), interval, args.window_ms), args.iterations)
+    measure('coalesced + gzip',
+            lambda: coalesced_events(deltas, FakeClock(), interval, args.window_ms), args.iterations, compress=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""
+起動時間を測る。
+
+- cold import: 新しいプロセスで `import app` にかかる時間 (API キー無しでも落ちないこと)
+- first request: import 後の最初の /healthz・/readyz が ready になるまで・最初の /llm のレイテンシ
+
+    python bench/startup.py --runs 5
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+COLD_IMPORT = '''
+import time
+started = time.perf_counter()
+import app
+print(time.perf_counter() - started)
+'''
+
+FIRST_REQUEST = '''
+import json, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+client = app.app.test_client()
+client.get('/healthz')
+healthz = time.perf_counter()
+while client.get('/readyz').status_code != 200:
+    time.sleep(0.01)
+ready = time.perf_counter()
+client.post('/llm', json={'message': 'hello'})
+first_llm = time.perf_counter()
+client.post('/llm', json={'message': 'hello'})
+second_llm = time.perf_counter()
+print(json.dumps({
+    'import': imported - started,
+    'first_healthz': healthz - imported,
+    'until_ready': ready - imported,
+    'first_llm': first_llm - ready,
+    'second_llm': second_llm - first_llm,
+}))
+'''
+
+
+def run_python(code, env):
+    output = subprocess.run([sys.executable, '-c', code], cwd=ROOT, env=env, check=True,
+                            capture_output=True, text=True).stdout
+    return output.strip().splitlines()[-1]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    env = dict(os.environ, SHARED_STATE_PATH=os.path.join(tempfile.mkdtemp(), 'state.sqlite3'))
+    env.pop('OPENAI_API_KEY', None)
+    imports = [float(run_python(COLD_IMPORT, env)) for _ in range(args.runs)]
+    print(json.dumps({'cold_import_median': round(statistics.median(imports), 4)}))
+
+    env.update(OPENAI_BACKEND='stub', STUB_LATENCY_LLM='0.2')
+    runs = [json.loads(run_python(FIRST_REQUEST, env)) for _ in range(args.runs)]
+    print(json.dumps({key: round(statistics.median(r[key] for r in runs), 4) for key in runs[0]}))
+
+
+if __name__ == '__main__':
+    main()
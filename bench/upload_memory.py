@@ -0,0 +1,76 @@
+"""
+アップロード1件あたりのメモリ使用量 (tracemalloc のピーク) を旧経路と新経路で比較する。
+
+    python bench/upload_memory.py --seconds 120
+"""
+import argparse
+import io
+import os
+import sys
+import tempfile
+import tracemalloc
+
+import numpy as np
+import soundfile as sf
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from uploads import prepare_stt_file  # noqa: E402
+
+
+def consume(file):
+    # HTTP クライアントがマルチパートで送るのと同様にチャンク単位で読む
+    if isinstance(file, tuple):
+        file = file[1]
+    while file.read(64 * 1024):
+        pass
+
+
+def legacy_path(upload):
+    # 変更前: BytesIO(read()) → float64 にデコード → WAV に再エンコード
+    audio_stream = io.BytesIO(upload.read())
+    data, samplerate = sf.read(audio_stream)
+    wav_io = io.BytesIO()
+    wav_io.name = 'input.wav'
+    sf.write(wav_io, data, samplerate, format='WAV')
+    wav_io.seek(0)
+    consume(wav_io)
+
+
+def spooled_path(upload, filename):
+    consume(prepare_stt_file(upload, filename))
+
+
+def measure(label, func, *args):
+    tracemalloc.start()
+    func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'{label:<32} peak {peak / 1024 / 1024:8.2f} MiB')
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seconds', type=float, default=120)
+    parser.add_argument('--samplerate', type=int, default=44100)
+    args = parser.parse_args()
+
+    samples = (np.random.default_rng(0).standard_normal(int(args.seconds * args.samplerate)) * 0.1).astype('float32')
+    with tempfile.TemporaryDirectory() as tmp:
+        wav_path = os.path.join(tmp, 'recording.wav')
+        aiff_path = os.path.join(tmp, 'recording.aiff')
+        sf.write(wav_path, samples, args.samplerate, subtype='PCM_16')
+        sf.write(aiff_path, samples, args.samplerate, subtype='PCM_16')
+        del samples
+        print(f'upload size: {os.path.getsize(wav_path) / 1024 / 1024:.2f} MiB ({args.seconds:.0f}s)')
+
+        with open(wav_path, 'rb') as f:
+            measure('legacy (wav)', legacy_path, f)
+        with open(wav_path, 'rb') as f:
+            measure('spooled passthrough (wav)', spooled_path, f, 'recording.wav')
+        with open(aiff_path, 'rb') as f:
+            measure('spooled block decode (aiff)', spooled_path, f, 'recording.aiff')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""
+mock/main.py の録音について、固定 5 秒の録音と VAD による発話終了検出を比べる。
+
+録音を 0.1 秒ごとのブロックで Endpointer に流し、話し終えてから録音が終わるまでの待ち時間、
+文字起こしに渡す秒数、ブロックあたりの判定コストを表示する。
+
+mock/ のサンプル録音は発話を含まない (背景雑音だけの) ので、そのまま流した結果に加えて、
+サンプルの雑音の上に発話相当の音 (音節の速さで振幅が揺れる調波音) を重ねた録音でも測る。
+
+    python bench/vad_endpointing.py --trailing-silence 0.8
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import soundfile as sf
+
+MOCK_DIR = os.path.join(os.path.dirname(__file__), '..', 'mock')
+sys.path.insert(0, MOCK_DIR)
+from vad import Endpointer  # noqa: E402
+
+FIXED_DURATION = 5.0
+SAMPLES = ('temp.wav', 'output.wav')
+# 発話の長さ (秒)。短い返事から 5 秒を超える回答まで
+SPEECH_DURATIONS = (0.6, 1.2, 2.0, 3.0, 4.0, 6.0, 8.0)
+SPEECH_LEAD = 0.5
+
+
+def speech_like(seconds, fs, level_db=-26, seed=0):
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * fs)) / fs
+    pitch = 140 + 20 * np.sin(2 * np.pi * 0.5 * t)
+    phase = 2 * np.pi * np.cumsum(pitch) / fs
+    voice = sum(np.sin(k * phase) / k for k in range(1, 6))
+    # 1秒あたり4音節ほどの振幅変化
+    envelope = 0.55 + 0.45 * np.sin(2 * np.pi * 4 * t + rng.uniform(0, 2 * np.pi))
+    voice = voice * envelope
+    return (voice / np.sqrt(np.mean(voice ** 2)) * 10 ** (level_db / 20)).astype(np.float32)
+
+
+def with_noise(noise, speech, fs, total):
+    audio = np.resize(noise, int(total * fs)).astype(np.float32)
+    start = int(SPEECH_LEAD * fs)
+    end = min(start + len(speech), len(audio))
+    audio[start:end] += speech[:end - start]
+    return audio
+
+
+def endpoint(audio, fs, args):
+    endpointer = Endpointer(fs, trailing_silence=args.trailing_silence, max_duration=args.max_duration,
+                            no_speech_timeout=args.no_speech_timeout)
+    block = int(args.block * fs)
+    cpu = 0.0
+    blocks = 0
+    for offset in range(0, len(audio), block):
+        started = time.perf_counter()
+        done = endpointer.feed(audio[offset:offset + block].reshape(-1, 1))
+        cpu += time.perf_counter() - started
+        blocks += 1
+        if done:
+            break
+    return endpointer.elapsed(), len(endpointer.speech_region()) / fs, cpu / blocks
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--trailing-silence', type=float, default=0.8)
+    parser.add_argument('--max-duration', type=float, default=30)
+    parser.add_argument('--no-speech-timeout', type=float, default=5)
+    parser.add_argument('--block', type=float, default=0.1)
+    args = parser.parse_args()
+
+    print('--- sample recordings (no speech)')
+    for name in SAMPLES:
+        noise, fs = sf.read(os.path.join(MOCK_DIR, name), dtype='float32')
+        recorded, sent, cpu = endpoint(noise, fs, args)
+        print(f'{name:<11} recording {recorded:4.1f} s (fixed {FIXED_DURATION:.1f} s)  '
+              f'sent to STT {sent:4.1f} s (fixed {len(noise) / fs:.1f} s)  vad {cpu * 1e6:4.0f} us/block')
+
+    noise, fs = sf.read(os.path.join(MOCK_DIR, SAMPLES[0]), dtype='float32')
+    print(f'--- speech over {SAMPLES[0]} noise, trailing silence {args.trailing_silence} s')
+    saved = []
+    for i, seconds in enumerate(SPEECH_DURATIONS):
+        speech_end = SPEECH_LEAD + seconds
+        audio = with_noise(noise, speech_like(seconds, fs, seed=i), fs, speech_end + args.no_speech_timeout + 2)
+        recorded, sent, cpu = endpoint(audio, fs, args)
+        vad_wait = recorded - speech_end
+        if speech_end <= FIXED_DURATION:
+            fixed = f'wait {FIXED_DURATION - speech_end:4.1f} s'
+            saved.append(FIXED_DURATION - speech_end - vad_wait)
+        else:
+            fixed = f'cut {speech_end - FIXED_DURATION:4.1f} s'
+        print(f'speech {seconds:4.1f} s  vad: wait {vad_wait:4.1f} s, sent {sent:4.1f} s  fixed: {fixed}  '
+              f'vad {cpu * 1e6:4.0f} us/block')
+    print(f'average turn latency saved (answers within {FIXED_DURATION:.0f} s): {np.mean(saved):.2f} s '
+          f'over {len(saved)} turns')
+
+
+if __name__ == '__main__':
+    main()
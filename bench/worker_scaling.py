@@ -0,0 +1,91 @@
+"""
+gunicorn のワーカー数を変えてスループットを測る。上流はスタブ (stub_backend.py)。
+
+    python bench/worker_scaling.py --workers 1 2 4 --clients 16 --seconds 10
+"""
+import argparse
+import concurrent.futures
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from metrics import LatencyHistogram  # noqa: E402
+
+
+def wait_until_up(base_url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(base_url + '/status', timeout=1).read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f'server at {base_url} did not start')
+
+
+def client_loop(base_url, deadline, histogram):
+    # sync ワーカーは1接続ずつ accept するので、ワーカー数の効果がそのまま現れる
+    # cookie を持ち回り、セッションごとのスレッドが全ワーカーで共有されることも確かめる
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor())
+    done = errors = 0
+    while time.monotonic() < deadline:
+        body = json.dumps({'message': '自己紹介をお願いします。'}).encode()
+        req = urllib.request.Request(base_url + '/llm', data=body, headers={'Content-Type': 'application/json'})
+        started = time.perf_counter()
+        try:
+            opener.open(req, timeout=60).read()
+        except OSError:
+            errors += 1
+            continue
+        histogram.record(time.perf_counter() - started)
+        done += 1
+    return done, errors
+
+
+def run(workers, clients, seconds, port):
+    base_url = f'http://127.0.0.1:{port}'
+    env = dict(os.environ, OPENAI_BACKEND='stub', WEB_CONCURRENCY=str(workers), GUNICORN_WORKER_CLASS='sync', GUNICORN_THREADS='1',
+               BIND=f'127.0.0.1:{port}',
+               SHARED_STATE_PATH=os.path.join(tempfile.mkdtemp(), 'state.sqlite3'))
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py'], cwd=ROOT, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_until_up(base_url)
+        histogram = LatencyHistogram()
+        deadline = time.monotonic() + seconds
+        with concurrent.futures.ThreadPoolExecutor(clients) as pool:
+            results = list(pool.map(lambda _: client_loop(base_url, deadline, histogram), range(clients)))
+        done = sum(r[0] for r in results)
+        errors = sum(r[1] for r in results)
+        return {'workers': workers, 'requests': done, 'errors': errors,
+                'rps': round(done / seconds, 2), 'latency': histogram.summary()}
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+
+    baseline = None
+    for workers in args.workers:
+        result = run(workers, args.clients, args.seconds, args.port)
+        baseline = baseline or result['rps']
+        result['speedup'] = round(result['rps'] / baseline, 2) if baseline else 0.0
+        print(json.dumps(result, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,21 @@
+# gunicorn -c gunicorn.conf.py
+# アプリはマスターで一度だけ読み込み (preload)、各ワーカーに fork する。
+# 会話スレッドやカウンタは shared_state.py の SQLite に置くので、スティッキーセッションは不要。
+import multiprocessing
+import os
+
+# app.py が読み込み時に作るインスタンスを使う (ファクトリを呼ぶとアプリを2つ作ることになる)
+wsgi_app = 'app:app'
+bind = os.getenv('BIND', '0.0.0.0:8000')
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+# SSE で長く繋がるリクエストがあるのでスレッドワーカーにする
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.getenv('GUNICORN_THREADS', '4'))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '120'))
+preload_app = True
+
+
+# ソケットを受け取ったワーカーで、上流との接続をバックグラウンドで温めておく
+def post_worker_init(worker):
+    from app import assistant
+    assistant.start_warm_up()
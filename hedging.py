@@ -0,0 +1,224 @@
+import collections
+import concurrent.futures
+import os
+import queue
+import threading
+import time
+
+from metrics import LatencyHistogram
+from shared_state import state
+
+# ヘッジする段 (カンマ区切り、例: "stt,tts")。空なら無効
+HEDGE_STAGES = {stage.strip() for stage in os.getenv('HEDGE_STAGES', '').split(',') if stage.strip()}
+# このパーセンタイルのレイテンシを過ぎても返ってこなければ2本目を送る
+HEDGE_PERCENTILE = float(os.getenv('HEDGE_PERCENTILE', '95'))
+# これだけ観測が溜まるまではヘッジしない
+HEDGE_MIN_SAMPLES = int(os.getenv('HEDGE_MIN_SAMPLES', '20'))
+# 追加で送るリクエストの上限 (通常の呼び出しに対する比率)
+HEDGE_MAX_EXTRA_RATIO = float(os.getenv('HEDGE_MAX_EXTRA_RATIO', '0.1'))
+# 短い間に使える追加リクエストの上限
+HEDGE_MAX_BURST = 10.0
+
+
+def _start(fn, *args):
+    """fn を別スレッドで実行し、その結果の Future を返す。"""
+    future = concurrent.futures.Future()
+
+    def run():
+        try:
+            future.set_result(fn(*args))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+
+class Hedger:
+    """
+    冪等な上流呼び出し (文字起こし・音声合成) のテールレイテンシを削るヘッジ。
+
+    呼び出しがモデルごとに追跡したパーセンタイルを過ぎても返ってこなければ、同じリクエストをもう1本送り、
+    先に終わった方を使う。負けた方には cancelled を立てる (途中で止められない呼び出しは結果を捨てる)。
+    追加のリクエストはトークンバケットで HEDGE_MAX_EXTRA_RATIO までに抑える。
+    """
+    def __init__(self, stages=HEDGE_STAGES, percentile=HEDGE_PERCENTILE, min_samples=HEDGE_MIN_SAMPLES,
+                 max_extra_ratio=HEDGE_MAX_EXTRA_RATIO, max_burst=HEDGE_MAX_BURST):
+        self.stages = set(stages)
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.max_extra_ratio = max_extra_ratio
+        self.max_burst = max_burst
+        self._lock = threading.Lock()
+        self._tokens = 0.0
+        self._latency = collections.defaultdict(LatencyHistogram)
+
+    def enabled(self, stage):
+        return stage in self.stages
+
+    def observe(self, key, seconds, size=1):
+        self._latency[key].record(seconds / max(size, 1))
+
+    def hedge_delay(self, key, size=1):
+        """2本目を送るまでの秒数。観測が足りなければ None。"""
+        histogram = self._latency.get(key)
+        if histogram is None or histogram.count < self.min_samples:
+            return None
+        return histogram.percentile(self.percentile) * max(size, 1)
+
+    def _take_token(self):
+        with self._lock:
+            if self._tokens >= 1.0:
+                self._tokens -= 1.0
+                return True
+            return False
+
+    def _add_tokens(self):
+        with self._lock:
+            self._tokens = min(self._tokens + self.max_extra_ratio, self.max_burst)
+
+    def _timed(self, attempt, cancelled):
+        started = time.perf_counter()
+        return attempt(cancelled), time.perf_counter() - started
+
+    def call(self, stage, model, attempt, size=1):
+        """
+        attempt(cancelled) を実行して結果を返す。遅ければ同じ attempt をもう1本走らせる。
+        レイテンシは size (音声合成なら文字数) あたりで追跡する。
+        """
+        key = f'{stage}.{model}'
+        delay = self.hedge_delay(key, size) if self.enabled(stage) else None
+        self._add_tokens()
+        if delay is None:
+            result, elapsed = self._timed(attempt, threading.Event())
+            self.observe(key, elapsed, size)
+            return result
+
+        cancels = [threading.Event()]
+        attempts = [_start(self._timed, attempt, cancels[0])]
+        done, _ = concurrent.futures.wait(attempts, timeout=delay)
+        if not done:
+            if self._take_token():
+                state.incr(f'hedge.{stage}.fired')
+                cancels.append(threading.Event())
+                attempts.append(_start(self._timed, attempt, cancels[1]))
+            else:
+                state.incr(f'hedge.{stage}.capped')
+
+        # 先に成功した方を使う。両方失敗したら最初の呼び出しの例外を投げる
+        pending = set(attempts)
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    for cancel in cancels:
+                        cancel.set()
+                    if attempts.index(future) > 0:
+                        state.incr(f'hedge.{stage}.won')
+                    result, elapsed = future.result()
+                    self.observe(key, elapsed, size)
+                    return result
+        return attempts[0].result()
+
+    def stream(self, stage, model, attempt, size=1):
+        """
+        ストリーミング版。attempt(cancelled) はチャンクを yield するジェネレータ関数。
+
+        最初のチャンクが追跡したパーセンタイルまでに届かなければもう1本走らせ、
+        先に最初のチャンクを返した方だけを最後まで流す。
+        """
+        key = f'{stage}.{model}.first_chunk'
+        delay = self.hedge_delay(key, size) if self.enabled(stage) else None
+        self._add_tokens()
+        if delay is None:
+            started = time.perf_counter()
+            first = True
+            for chunk in attempt(threading.Event()):
+                if first:
+                    self.observe(key, time.perf_counter() - started, size)
+                    first = False
+                yield chunk
+            return
+
+        chunks = queue.Queue()
+        cancels = []
+
+        def pump(index, cancelled):
+            started = time.perf_counter()
+            first = True
+            chunk_iter = attempt(cancelled)
+            try:
+                for chunk in chunk_iter:
+                    if first:
+                        chunks.put(('first', index, time.perf_counter() - started))
+                        first = False
+                    chunks.put(('chunk', index, chunk))
+                    if cancelled.is_set():
+                        return
+                chunks.put(('end', index, None))
+            except BaseException as e:
+                chunks.put(('error', index, e))
+            finally:
+                chunk_iter.close()
+
+        def launch():
+            cancels.append(threading.Event())
+            threading.Thread(target=pump, args=(len(cancels) - 1, cancels[-1]), daemon=True).start()
+
+        launch()
+        winner = None
+        errors = {}
+        deadline = time.monotonic() + delay
+        try:
+            while True:
+                timeout = None
+                if winner is None and deadline is not None:
+                    timeout = max(deadline - time.monotonic(), 0.0)
+                try:
+                    kind, index, payload = chunks.get(timeout=timeout)
+                except queue.Empty:
+                    deadline = None
+                    if self._take_token():
+                        state.incr(f'hedge.{stage}.fired')
+                        launch()
+                    else:
+                        state.incr(f'hedge.{stage}.capped')
+                    continue
+
+                if winner is None:
+                    if kind == 'error':
+                        # 走らせた全部が失敗したら、最初の呼び出しの例外を投げる
+                        errors[index] = payload
+                        if len(errors) == len(cancels):
+                            raise errors.get(0, payload)
+                        continue
+                    winner = index
+                    for i, cancel in enumerate(cancels):
+                        if i != winner:
+                            cancel.set()
+                    if winner > 0:
+                        state.incr(f'hedge.{stage}.won')
+                if index != winner:
+                    continue
+                if kind == 'first':
+                    self.observe(key, payload, size)
+                elif kind == 'chunk':
+                    yield payload
+                elif kind == 'end':
+                    return
+                else:
+                    raise payload
+        finally:
+            # 受け手が途中でやめた場合 (割り込みなど) も含め、まだ動いている送信を止める
+            for cancel in cancels:
+                cancel.set()
+
+    def snapshot(self):
+        """キーごとの観測数とヘッジのしきい値 (size あたりの秒数)。"""
+        return {
+            key: {'count': histogram.count, 'threshold': round(histogram.percentile(self.percentile), 5)}
+            for key, histogram in list(self._latency.items())
+        }
+
+
+hedger = Hedger()
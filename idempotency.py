@@ -0,0 +1,91 @@
+import concurrent.futures
+import hashlib
+import os
+import threading
+import time
+import uuid
+
+from shared_state import state
+
+# 同じ送信をまとめる時間窓 (秒)
+IDEMPOTENCY_WINDOW = float(os.getenv('IDEMPOTENCY_WINDOW_S', '120'))
+# 他のワーカーで処理中の結果を待つ間隔
+_POLL_INTERVAL = 0.1
+_HASH_CHUNK_BYTES = 1024 * 1024
+
+_lock = threading.Lock()
+_in_flight = {}
+
+
+def idempotency_key(request, route, session_id, audio_stream=None, extra=()):
+    """
+    クライアントが Idempotency-Key を送っていればそれを、無ければアップロード内容のハッシュを使う。
+    セッションとルートごとに分けるので、別の利用者の結果が返ることはない。
+    """
+    client_key = request.headers.get('Idempotency-Key') or request.form.get('idempotency_key')
+    if client_key:
+        digest = client_key
+    else:
+        h = hashlib.sha256()
+        if audio_stream is not None:
+            audio_stream.seek(0)
+            for chunk in iter(lambda: audio_stream.read(_HASH_CHUNK_BYTES), b''):
+                h.update(chunk)
+            audio_stream.seek(0)
+        digest = h.hexdigest()
+    return ':'.join([route, session_id, digest, *map(str, extra)])
+
+
+def run_once(key, compute, window=IDEMPOTENCY_WINDOW, timeout=300):
+    """
+    同じ key の処理を時間窓の中で1回だけ実行し、重複した呼び出しには同じ結果を返す。
+
+    同じプロセス内の重複は実行中の Future を待ち、別ワーカーの重複は共有状態の結果を待つ。
+    compute の結果は JSON にできる値であること。失敗した場合は記録を消し、次の送信で再実行できるようにする。
+    """
+    with _lock:
+        future = _in_flight.get(key)
+        owner = future is None
+        if owner:
+            future = concurrent.futures.Future()
+            _in_flight[key] = future
+    if not owner:
+        state.incr('idempotency.duplicates_avoided')
+        return future.result(timeout=timeout)
+
+    try:
+        result = _run_shared(key, compute, window, timeout)
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    else:
+        future.set_result(result)
+        return result
+    finally:
+        with _lock:
+            _in_flight.pop(key, None)
+
+
+def _run_shared(key, compute, window, timeout):
+    token = uuid.uuid4().hex
+    deadline = time.monotonic() + timeout
+    while True:
+        entry = state.setdefault('idempotency', key, {'status': 'pending', 'token': token}, ttl=window)
+        if entry.get('token') == token:
+            break
+        if entry['status'] == 'done':
+            state.incr('idempotency.duplicates_avoided')
+            return entry['result']
+        # 別のワーカーが処理中。終わるか、失敗して記録が消えるまで待つ
+        if time.monotonic() > deadline:
+            raise TimeoutError(f'timed out waiting for in-flight request {key}')
+        time.sleep(_POLL_INTERVAL)
+
+    try:
+        result = compute()
+    except BaseException:
+        state.delete('idempotency', key)
+        raise
+    state.set('idempotency', key, {'status': 'done', 'token': token, 'result': result}, ttl=window)
+    state.purge_expired()
+    return result
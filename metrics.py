@@ -0,0 +1,61 @@
+import math
+import threading
+
+
+class LatencyHistogram:
+    """
+    対数バケットでレイテンシを集計するヒストグラム。
+    サンプル数に関係なくメモリ使用量は一定。
+    """
+    # 1ms〜約1000秒を 1バケットあたり約5%刻みで表現
+    min_value = 0.001
+    growth = 1.05
+    num_buckets = 300
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = [0] * (self.num_buckets + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def _bucket_index(self, seconds):
+        if seconds <= self.min_value:
+            return 0
+        index = int(math.log(seconds / self.min_value, self.growth)) + 1
+        return min(index, self.num_buckets)
+
+    def _bucket_upper(self, index):
+        return self.min_value * (self.growth ** index)
+
+    def record(self, seconds):
+        with self._lock:
+            self._buckets[self._bucket_index(seconds)] += 1
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+
+    def percentile(self, p):
+        """p (0-100) パーセンタイルの近似値 (秒) を返す。"""
+        with self._lock:
+            if self.count == 0:
+                return 0.0
+            target = max(1, math.ceil(self.count * p / 100.0))
+            seen = 0
+            for index, bucket_count in enumerate(self._buckets):
+                seen += bucket_count
+                if seen >= target:
+                    return min(self._bucket_upper(index), self.max)
+            return self.max
+
+    def summary(self):
+        mean = self.total / self.count if self.count else 0.0
+        return {
+            'count': self.count,
+            'mean': round(mean, 4),
+            'p50': round(self.percentile(50), 4),
+            'p90': round(self.percentile(90), 4),
+            'p95': round(self.percentile(95), 4),
+            'p99': round(self.percentile(99), 4),
+            'max': round(self.max, 4),
+        }
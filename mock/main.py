@@ -7,6 +7,8 @@ import time
 import sounddevice as sd
 import soundfile as sf
 
+from vad import Endpointer
+
 # .envファイルからAPIキーとアシスタントIDを読み込む
 load_dotenv()
 api_key = os.getenv('OPENAI_API_KEY')
@@ -18,8 +20,11 @@ class AIAssistant:
     """
     # 録音パラメータ
     fs = 44100  # サンプリングレート
-    duration = 5  # 録音する秒数
     channels = 1  # モノラル録音
+    block_duration = 0.1  # 発話の終わりを判定する間隔 (秒)
+    trailing_silence = 0.8  # この秒数だけ無音が続いたら録音を終える
+    max_duration = 30  # 録音する最大の秒数
+    no_speech_timeout = 5  # 話し始めないまま待つ秒数
     # 音声認識モデル
     stt_model = "whisper-1"
     # 音声生成モデル
@@ -44,16 +49,24 @@ class AIAssistant:
         """
         オーディオを録音する。
 
+        ブロックごとに発話の終わりを判定し、話し終えたら (または max_duration 秒で) 録音を終える。
+
         Returns:
-            any: 録音データ。
+            any: 発話区間の録音データ。発話が無ければ空の配列。
         """
-        st.write("Start recording...")
-        recorded_data = sd.rec(
-            int(self.duration * self.fs), samplerate=self.fs, channels=self.channels
+        endpointer = Endpointer(
+            self.fs,
+            trailing_silence=self.trailing_silence,
+            max_duration=self.max_duration,
+            no_speech_timeout=self.no_speech_timeout,
         )
-        sd.wait()  # 録音が終わるまで待機
+        st.write("Start recording...")
+        with sd.InputStream(samplerate=self.fs, channels=self.channels, dtype="float32") as stream:
+            while not endpointer.done:
+                block, _ = stream.read(int(self.block_duration * self.fs))
+                endpointer.feed(block)
         st.write("...Finished recording")
-        return recorded_data
+        return endpointer.speech_region()
 
     def transcribe_audio(self, audio_data: any) -> str:
         """
@@ -65,6 +78,10 @@ class AIAssistant:
         Returns:
             str: 変換されたテキスト。
         """
+        # 発話が無かったときは文字起こしを呼ばない
+        if len(audio_data) == 0:
+            return ""
+
         audio_file = io.BytesIO()
         sf.write(audio_file, audio_data, self.fs, format='wav')
         audio_file.seek(0)
@@ -1,13 +1,14 @@
 import os
 import streamlit as st
-from openai import OpenAI
+from openai import AsyncOpenAI
 from dotenv import load_dotenv
 import io
-import time
 import asyncio
+import numpy as np
 import sounddevice as sd
 import soundfile as sf
-from scipy.io.wavfile import write
+
+from vad import Endpointer
 
 # .envファイルからAPIキーとアシスタントIDを読み込む
 load_dotenv()
@@ -15,81 +16,210 @@ api_key = os.getenv('OPENAI_API_KEY')
 assistant_id = os.getenv('ASSISTANT_ID')
 
 class AIAssistant:
-    def __init__(self, assistant_id: str, api_key: str):
+    def __init__(self, assistant_id: str, api_key: str, thread_id: str = None):
+        # AsyncOpenAI の接続は作ったイベントループに紐づくので、asyncio.run のたびに作り直す
         self.assistant_id = assistant_id
-        self.client = OpenAI()
-        self.client.api_key = api_key
+        self.client = AsyncOpenAI(api_key=api_key)
         self.stt_model = "whisper-1"
         self.tts_model = "tts-1"
         self.voice_code = "nova"
         self.fs = 44100
-        self.duration = 5
+        self.block_duration = 0.1
+        self.trailing_silence = 0.8
+        self.max_duration = 30
+        self.no_speech_timeout = 5
         self.channels = 1
-        self.thread_id = None
+        # 文字起こし待ちの発話。処理が追いつかないときは古いものから捨てる
+        self.max_pending_utterances = 2
+        # 再生中はスピーカーの音がマイクに回り込むので、再生開始直後のマイクの音量 (回り込みの大きさ) を測り、
+        # それより echo_margin_db 以上大きい音だけを発話とみなす
+        self.echo_calibration = 0.3
+        self.echo_margin_db = 6
+        self.thread_id = thread_id
         self.is_running = False
+        self.is_playing = False
+        self.barge_in = False
+        self.replies = None
 
     async def start_thread(self):
-        self.thread_id = self.client.beta.threads.create().id
+        self.thread_id = (await self.client.beta.threads.create()).id
+
+    def new_endpointer(self):
+        return Endpointer(self.fs, trailing_silence=self.trailing_silence, max_duration=self.max_duration,
+                          no_speech_timeout=self.no_speech_timeout)
+
+    async def record_audio(self, utterances):
+        # 録音はコールバックで受け取り、発話の終わりを検出するたびに発話区間を utterances に入れる
+        # 応答の文字起こし・生成・再生中も止めずに次の発話を録音し、無音だけの区間は文字起こしに送らない
+        # 再生中に回り込みより大きな声で話し始めたら割り込みとみなして再生を止める
+        loop = asyncio.get_running_loop()
+        blocks = asyncio.Queue()
 
-    async def record_audio(self):
-        print("Start recording...")
-        loop = asyncio.get_event_loop()
-        recording = await loop.run_in_executor(None, lambda: sd.rec(int(self.duration * self.fs), samplerate=self.fs, channels=self.channels))
-        sd.wait()
+        def callback(indata, frames, time_info, status):
+            loop.call_soon_threadsafe(blocks.put_nowait, (self.is_playing, indata.copy()))
+
+        echo_blocks = max(1, round(self.echo_calibration / self.block_duration))
+        with sd.InputStream(samplerate=self.fs, channels=self.channels, dtype="int16", callback=callback,
+                            blocksize=int(self.block_duration * self.fs)):
+            print("Start recording...")
+            endpointer = self.new_endpointer()
+            default_min_level_db = endpointer.min_level_db
+            echo_levels = []
+            while self.is_running:
+                playing, block = await blocks.get()
+                if playing:
+                    # 回り込みの大きさが分かるまでは発話と判定しない (録音自体は続ける)
+                    if len(echo_levels) < echo_blocks:
+                        echo_levels.append(block_level_db(block))
+                        echo_floor_db = 0.0
+                    else:
+                        echo_floor_db = float(np.median(echo_levels)) + self.echo_margin_db
+                    endpointer.min_level_db = max(default_min_level_db, echo_floor_db)
+                else:
+                    echo_levels = []
+                    endpointer.min_level_db = default_min_level_db
+                done = endpointer.feed(block)
+                if playing and endpointer.speech_start is not None:
+                    self.interrupt_playback()
+                if not done:
+                    continue
+                speech = endpointer.speech_region()
+                endpointer = self.new_endpointer()
+                if len(speech) == 0:
+                    continue
+                if utterances.full():
+                    utterances.get_nowait()
+                    print("Dropped an utterance: transcription is falling behind")
+                utterances.put_nowait(speech)
         print("...Finished recording")
-        return recording
 
     async def transcribe_audio(self, audio_data):
-        write("temp.wav", self.fs, audio_data)
-        with open("temp.wav", "rb") as audio_file:
-            transcript = self.client.audio.transcriptions.create(model=self.stt_model, file=audio_file)
+        # 録音ごとに一時ファイルを共有しないよう、メモリ上でWAVにする
+        buffer = io.BytesIO()
+        sf.write(buffer, audio_data, self.fs, format="WAV", subtype="PCM_16")
+        buffer.seek(0)
+        transcript = await self.client.audio.transcriptions.create(model=self.stt_model, file=("temp.wav", buffer))
         return transcript.text
 
     async def run_thread_actions(self, text):
-        self.client.beta.threads.messages.create(thread_id=self.thread_id, role="user", content=text)
-        run = self.client.beta.threads.runs.create(thread_id=self.thread_id, assistant_id=self.assistant_id)
+        await self.client.beta.threads.messages.create(thread_id=self.thread_id, role="user", content=text)
+        run = await self.client.beta.threads.runs.create(thread_id=self.thread_id, assistant_id=self.assistant_id)
         while True:
-            result = self.client.beta.threads.runs.retrieve(thread_id=self.thread_id, run_id=run.id)
+            result = await self.client.beta.threads.runs.retrieve(thread_id=self.thread_id, run_id=run.id)
             if result.status == "completed":
                 break
             await asyncio.sleep(0.5)
-        messages = self.client.beta.threads.messages.list(thread_id=self.thread_id, order="asc")
+        messages = await self.client.beta.threads.messages.list(thread_id=self.thread_id, order="asc")
         if len(messages.data) < 2:
             return ""
         return messages.data[-1].content[0].text.value
 
     async def text_to_speech(self, text):
-        response = self.client.audio.speech.create(model=self.tts_model, voice=self.voice_code, input=text)
-        byte_stream = io.BytesIO(response.content)
-        audio_data, samplerate = sf.read(byte_stream)
-        sd.play(audio_data, samplerate)
-        sd.wait()
+        response = await self.client.audio.speech.create(model=self.tts_model, voice=self.voice_code, input=text)
+        # デコードは CPU を使うのでイベントループの外で行う
+        audio_data, samplerate = await asyncio.to_thread(sf.read, io.BytesIO(response.content), dtype="float32")
+        await self.play_audio(audio_data, samplerate)
+
+    async def play_audio(self, audio_data, samplerate):
+        # sd.play/sd.wait は録音と同じストリームを使い、待つ間ループを止めるので、専用の出力ストリームで再生する
+        loop = asyncio.get_running_loop()
+        finished = asyncio.Event()
+        audio_data = audio_data.reshape(len(audio_data), -1)
+        position = 0
+
+        def callback(outdata, frames, time_info, status):
+            nonlocal position
+            if self.barge_in:
+                outdata[:] = 0
+                raise sd.CallbackStop
+            chunk = audio_data[position:position + frames]
+            outdata[:len(chunk)] = chunk
+            outdata[len(chunk):] = 0
+            position += frames
+            if len(chunk) < frames:
+                raise sd.CallbackStop
+
+        self.barge_in = False
+        self.is_playing = True
+        try:
+            with sd.OutputStream(samplerate=samplerate, channels=audio_data.shape[1], dtype="float32",
+                                 callback=callback, finished_callback=lambda: loop.call_soon_threadsafe(finished.set)):
+                await finished.wait()
+        finally:
+            self.is_playing = False
+
+    def interrupt_playback(self):
+        # 再生中の応答と、まだ再生していない応答を捨てる
+        if self.barge_in:
+            return
+        self.barge_in = True
+        print("Barge-in: stopped playback")
+        while self.replies is not None and not self.replies.empty():
+            self.replies.get_nowait()
+
+    async def process_utterances(self, utterances, replies, events):
+        # 同じスレッドに run を並べて作れないので、発話は1つずつ順に処理する
+        while True:
+            recorded_data = await utterances.get()
+            transcript_text = await self.transcribe_audio(recorded_data)
+            await events.put(("user", transcript_text))
+            if transcript_text:
+                assistant_content = await self.run_thread_actions(transcript_text)
+                await events.put(("assistant", assistant_content))
+                await replies.put(assistant_content)
+
+    async def play_replies(self, replies):
+        while True:
+            await self.text_to_speech(await replies.get())
 
     async def interaction_loop(self):
+        # 録音・応答生成・再生を別々のタスクで並行に動かし、発言と応答ができた順に返す
         self.is_running = True
-        while self.is_running:
-            try:
-                recorded_data = await self.record_audio()
-                transcript_text = await self.transcribe_audio(recorded_data)
-                yield ("user", transcript_text)
-                if transcript_text:
-                    assistant_content = await self.run_thread_actions(transcript_text)
-                    await self.text_to_speech(assistant_content)
-                    yield ("assistant", assistant_content)
-            except Exception as e:
-                self.is_running = False
-                raise e
+        utterances = asyncio.Queue(maxsize=self.max_pending_utterances)
+        replies, events = asyncio.Queue(), asyncio.Queue()
+        self.replies = replies
+        tasks = [
+            asyncio.create_task(self.record_audio(utterances)),
+            asyncio.create_task(self.process_utterances(utterances, replies, events)),
+            asyncio.create_task(self.play_replies(replies)),
+        ]
+        try:
+            while self.is_running:
+                next_event = asyncio.create_task(events.get())
+                done, _ = await asyncio.wait([next_event, *tasks], return_when=asyncio.FIRST_COMPLETED)
+                if next_event in done:
+                    yield next_event.result()
+                    continue
+                next_event.cancel()
+                # どれかのタスクが例外で終わった
+                for task in done:
+                    task.result()
+                break
+        finally:
+            self.is_running = False
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
 
     def stop_interaction(self):
         self.is_running = False
 
+def block_level_db(block):
+    samples = block.astype(np.float32) / np.iinfo(block.dtype).max
+    return 10 * np.log10(np.mean(samples ** 2) + 1e-12)
+
 async def main():
     if 'is_running' not in st.session_state:
         st.session_state.is_running = False
     if 'messages' not in st.session_state:
         st.session_state.messages = []
 
-    ai_assistant = AIAssistant(assistant_id=assistant_id, api_key=api_key)
+    if 'thread_id' not in st.session_state:
+        st.session_state.thread_id = None
+
+    # ボタンを押すたびにスクリプトが再実行され、asyncio.run で新しいイベントループになる
+    # クライアントはループをまたいで使えないので、セッションには会話のスレッド ID だけを残す
+    ai_assistant = AIAssistant(assistant_id=assistant_id, api_key=api_key, thread_id=st.session_state.thread_id)
 
     st.title("AI Assistant with Real-Time Speech-to-Text and Text-to-Speech")
 
@@ -111,6 +241,7 @@ async def main():
     if st.button("Start Interaction"):
         st.session_state.is_running = True
         await ai_assistant.start_thread()
+        st.session_state.thread_id = ai_assistant.thread_id
 
     if st.button("Pause Interaction"):
         ai_assistant.stop_interaction()
@@ -123,21 +254,20 @@ async def main():
 
     # スクロール可能な枠にテキストを表示
     st.markdown('<div class="scrollable-container">', unsafe_allow_html=True)
+    messages_container = st.container()
     for role, message in st.session_state.messages:
-        if role == "user":
-            st.write(f"user: {message}")
-        elif role == "assistant":
-            st.write(f"assistant: {message}")
+        messages_container.write(f"{role}: {message}")
     st.markdown('</div>', unsafe_allow_html=True)
 
     if st.session_state.is_running:
-        interaction_generator = ai_assistant.interaction_loop()
+        if ai_assistant.thread_id is None:
+            await ai_assistant.start_thread()
+            st.session_state.thread_id = ai_assistant.thread_id
+        # 発言・応答ができるたびにその場で表示する
         try:
-            while True:
-                role, content = await interaction_generator.__anext__()
+            async for role, content in ai_assistant.interaction_loop():
                 st.session_state.messages.append((role, content))
-        except StopAsyncIteration:
-            pass
+                messages_container.write(f"{role}: {content}")
         except Exception as e:
             st.error(f"An error occurred: {e}")
 
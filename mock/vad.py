@@ -0,0 +1,134 @@
+import numpy as np
+
+
+class Endpointer:
+    """
+    録音をブロックごとに受け取り、発話の終わり (エンドポイント) を検出するクラス。
+
+    フレームごとの音量 (dBFS) を numpy でまとめて計算し、背景雑音より margin_db 以上大きいフレームを発話とみなす。
+    発話のあと trailing_silence 秒の無音が続くか、max_duration 秒に達したら終了する。
+    """
+
+    def __init__(self, fs: int, frame_ms: float = 30, trailing_silence: float = 0.8, max_duration: float = 30,
+                 no_speech_timeout: float = 5, margin_db: float = 12, min_level_db: float = -50,
+                 calibration: float = 0.3, min_speech: float = 0.15, padding: float = 0.2):
+        """
+        初期化処理。
+
+        Args:
+            fs (int): サンプリングレート。
+            frame_ms (float): 判定するフレームの長さ (ミリ秒)。
+            trailing_silence (float): 発話の終わりとみなす無音の秒数。
+            max_duration (float): 録音の最大秒数。
+            no_speech_timeout (float): 発話が始まらないまま諦めるまでの秒数。
+            margin_db (float): 背景雑音からこれだけ大きければ発話とみなす。
+            min_level_db (float): 発話とみなす最小の音量 (dBFS)。録音の途中で変えてもよい (再生中の回り込み対策など)。
+            calibration (float): 背景雑音の推定に使う録音開始からの秒数。
+            min_speech (float): これより短い音は物音として無視する秒数。
+            padding (float): 発話区間の前後に残す秒数。
+        """
+        self.fs = fs
+        self.frame_len = max(1, int(fs * frame_ms / 1000))
+        self.trailing_frames = self._frames(trailing_silence)
+        self.max_frames = self._frames(max_duration)
+        self.no_speech_frames = self._frames(no_speech_timeout)
+        self.margin_db = margin_db
+        self.min_level_db = min_level_db
+        self.calibration_frames = max(1, self._frames(calibration))
+        self.min_speech_frames = max(1, self._frames(min_speech))
+        self.padding_frames = self._frames(padding)
+
+        self._blocks = []
+        self._pending = np.zeros((0,), dtype=np.float32)
+        self._levels = []
+        self._voiced_tail = np.zeros((0,), dtype=bool)
+        self.frames = 0
+        self.threshold_db = None
+        self.speech_start = None
+        self.last_speech = None
+        self.done = False
+
+    def _frames(self, seconds: float) -> int:
+        return int(round(seconds * self.fs / self.frame_len))
+
+    def feed(self, block: np.ndarray) -> bool:
+        """
+        録音ブロックを追加する。
+
+        Args:
+            block (np.ndarray): 録音データ (サンプル数 × チャンネル数、または1次元)。
+
+        Returns:
+            bool: 録音を終えてよければ True。
+        """
+        if self.done:
+            return True
+        self._blocks.append(block)
+        mono = block.reshape(len(block), -1).mean(axis=1)
+        # 平均を取ると float になるので、整数の録音かどうかは元のブロックで判定する
+        if block.dtype.kind in 'iu':
+            mono = mono / np.iinfo(block.dtype).max
+        samples = np.concatenate([self._pending, mono.astype(np.float32)])
+        count = len(samples) // self.frame_len
+        self._pending = samples[count * self.frame_len:]
+        if count == 0:
+            return False
+
+        frames = samples[:count * self.frame_len].reshape(count, self.frame_len)
+        levels = 10 * np.log10(np.mean(frames ** 2, axis=1) + 1e-12)
+        offset = self.frames
+        self.frames += count
+
+        if self.threshold_db is None:
+            self._levels.append(levels)
+            if self.frames < self.calibration_frames:
+                return False
+            # 録音開始直後を背景雑音とみなす
+            levels = np.concatenate(self._levels)
+            noise_db = np.median(levels[:self.calibration_frames])
+            self.threshold_db = max(noise_db + self.margin_db, self.min_level_db)
+            offset = 0
+
+        self._update_speech(levels >= max(self.threshold_db, self.min_level_db), offset)
+        self.done = self._should_stop()
+        return self.done
+
+    def _update_speech(self, voiced: np.ndarray, offset: int) -> None:
+        # min_speech_frames 以上続いた有音区間だけを発話として扱う
+        # ブロックの境目をまたぐ有音区間も拾えるよう、前回の末尾をつなげて判定する
+        voiced = np.concatenate([self._voiced_tail, voiced])
+        offset -= len(self._voiced_tail)
+        self._voiced_tail = voiced[len(voiced) - self.min_speech_frames + 1:]
+        if len(voiced) < self.min_speech_frames:
+            return
+        window = np.ones(self.min_speech_frames, dtype=int)
+        runs = np.convolve(voiced.astype(int), window, mode='valid')
+        ends = np.flatnonzero(runs == self.min_speech_frames)
+        if len(ends) == 0:
+            return
+        if self.speech_start is None:
+            self.speech_start = offset + int(ends[0])
+        self.last_speech = offset + int(ends[-1]) + self.min_speech_frames - 1
+
+    def _should_stop(self) -> bool:
+        frames = self.frames
+        if frames >= self.max_frames:
+            return True
+        if self.speech_start is None:
+            return frames >= self.no_speech_frames
+        return frames - 1 - self.last_speech >= self.trailing_frames
+
+    def speech_region(self) -> np.ndarray:
+        """
+        録音のうち発話区間 (前後に padding 秒を含む) を返す。発話が無ければ空の配列。
+        """
+        audio = np.concatenate(self._blocks) if self._blocks else np.zeros((0,), dtype=np.float32)
+        if self.speech_start is None:
+            return audio[:0]
+        start = max(self.speech_start - self.padding_frames, 0) * self.frame_len
+        end = (self.last_speech + 1 + self.padding_frames) * self.frame_len
+        return audio[start:end]
+
+    def elapsed(self) -> float:
+        """これまでに受け取った録音の秒数。"""
+        return sum(len(block) for block in self._blocks) / self.fs
@@ -0,0 +1,116 @@
+import os
+import threading
+import time
+
+from shared_state import state
+
+
+def _tiers(name, default):
+    return [model.strip() for model in os.getenv(name, default).split(',') if model.strip()]
+
+
+# 段ごとのモデル候補。品質の高い順に並べる
+# llm が空のときはアシスタントに設定されたモデルをそのまま使う
+MODEL_TIERS = {
+    'stt': _tiers('STT_MODEL_TIERS', 'whisper-1'),
+    'llm': _tiers('LLM_MODEL_TIERS', ''),
+    'tts': _tiers('TTS_MODEL_TIERS', 'tts-1-hd,tts-1'),
+}
+# 1ターン (文字起こし〜応答音声) のレイテンシ予算
+TURN_LATENCY_BUDGET = float(os.getenv('TURN_LATENCY_BUDGET_MS', '8000')) / 1000.0
+# 予算を各段に配分する比率
+STAGE_BUDGET_SHARES = {'stt': 0.2, 'llm': 0.5, 'tts': 0.3}
+# EWMA の平滑化係数
+LATENCY_EWMA_ALPHA = float(os.getenv('LATENCY_EWMA_ALPHA', '0.3'))
+# これだけ観測の無いモデルは、予測が予算を超えていても一度試し直す
+MODEL_PROBE_INTERVAL = float(os.getenv('MODEL_PROBE_INTERVAL', '60'))
+
+
+class LatencyTracker:
+    """
+    モデルごとのレイテンシを EWMA で追跡する。
+
+    音声合成は入力文字数に比例するので、size (文字数など) あたりの秒数で持つ。
+    """
+    def __init__(self, alpha=LATENCY_EWMA_ALPHA):
+        self.alpha = alpha
+        self._lock = threading.Lock()
+        self._rates = {}
+        self._observed_at = {}
+
+    def observe(self, model, seconds, size=1):
+        rate = seconds / max(size, 1)
+        with self._lock:
+            previous = self._rates.get(model)
+            self._rates[model] = rate if previous is None else self.alpha * rate + (1 - self.alpha) * previous
+            self._observed_at[model] = time.monotonic()
+
+    def predict(self, model, size=1):
+        """予測レイテンシ (秒)。未観測なら None。"""
+        rate = self._rates.get(model)
+        return None if rate is None else rate * max(size, 1)
+
+    def seconds_since_observed(self, model):
+        observed_at = self._observed_at.get(model)
+        return float('inf') if observed_at is None else time.monotonic() - observed_at
+
+    def snapshot(self):
+        with self._lock:
+            return {model: round(rate, 5) for model, rate in self._rates.items()}
+
+
+class ModelSelector:
+    def __init__(self, tiers=MODEL_TIERS, probe_interval=MODEL_PROBE_INTERVAL):
+        self.tiers = tiers
+        self.probe_interval = probe_interval
+        self.tracker = LatencyTracker()
+
+    def select(self, stage, budget=None, size=1):
+        """
+        予算内に収まると予測される中で最も品質の高いモデルを返す。
+        収まるものが無ければ最速の予測のモデル。候補が無ければ None。
+        """
+        tiers = self.tiers.get(stage) or []
+        if not tiers:
+            return None
+        chosen = None
+        if budget is None:
+            chosen = tiers[0]
+        else:
+            for model in tiers:
+                predicted = self.tracker.predict(model, size)
+                if (predicted is None or predicted <= budget
+                        or self.tracker.seconds_since_observed(model) >= self.probe_interval):
+                    chosen = model
+                    break
+            if chosen is None:
+                chosen = min(tiers, key=lambda model: self.tracker.predict(model, size))
+        state.incr(f'models.{stage}.{chosen}')
+        return chosen
+
+    def observe(self, model, seconds, size=1):
+        if model:
+            self.tracker.observe(model, seconds, size)
+
+
+class TurnBudget:
+    """
+    1ターンの残り時間を各段に配分する。
+
+    deadline は time.time() 基準なので、セッションに保存して別リクエスト・別ワーカーに引き継げる。
+    """
+    def __init__(self, deadline=None, stages=('stt', 'llm', 'tts')):
+        self.deadline = deadline or time.time() + TURN_LATENCY_BUDGET
+        self.stages = list(stages)
+        # 段ごとに選ばれたモデル (レスポンスやメトリクスに載せる)
+        self.models = {}
+
+    def for_stage(self, stage):
+        """この段に使える秒数。残り時間を、まだ終わっていない段の比率で按分する。"""
+        remaining = max(self.deadline - time.time(), 0.0)
+        stages = self.stages[self.stages.index(stage):] if stage in self.stages else [stage]
+        total_share = sum(STAGE_BUDGET_SHARES[s] for s in stages)
+        return remaining * STAGE_BUDGET_SHARES[stage] / total_share
+
+
+selector = ModelSelector()
@@ -0,0 +1,97 @@
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+
+# 設定するとその下に各ターンの記録 (turns.jsonl と audio/) を残す
+SESSION_RECORD_DIR = os.getenv('SESSION_RECORD_DIR')
+# 記録対象のエンドポイント
+RECORDED_ENDPOINTS = ('main.start', 'main.transcribe', 'main.llm', 'main.llm_stream', 'main.tts', 'main.interrupt')
+# JSON ボディのうち記録するキー
+RECORDED_JSON_KEYS = ('message', 'format', 'stream', 'heard_ms', 'heard_chars', 'played_clips')
+# 音声と一緒に送られるフォームの項目のうち記録するキー
+RECORDED_FORM_KEYS = ('format',)
+
+
+class SessionRecorder:
+    """
+    面談の各ターン (ルート・タイミング・アップロード音声) を記録する。replay.py で再生できる。
+
+    turns.jsonl は1行1リクエスト。複数ワーカーから追記しても行単位で混ざらないよう、
+    1行を1回の write で書き込む。
+    """
+    def __init__(self, record_dir):
+        self.record_dir = record_dir
+        self.audio_dir = os.path.join(record_dir, 'audio')
+        self.log_path = os.path.join(record_dir, 'turns.jsonl')
+        self._lock = threading.Lock()
+        os.makedirs(self.audio_dir, exist_ok=True)
+
+    def save_audio(self, file_storage):
+        _, ext = os.path.splitext(file_storage.filename or '')
+        name = f'{uuid.uuid4().hex}{ext or ".wav"}'
+        stream = file_storage.stream
+        stream.seek(0)
+        with open(os.path.join(self.audio_dir, name), 'wb') as f:
+            shutil.copyfileobj(stream, f)
+        stream.seek(0)
+        return os.path.join('audio', name), file_storage.filename
+
+    def record(self, session_id, route, method, started_at, elapsed, status, audio=None, filename=None, body=None,
+               form=None):
+        entry = {
+            'session': session_id,
+            'ts': round(started_at, 4),
+            'route': route,
+            'method': method,
+            'elapsed': round(elapsed, 4),
+            'status': status,
+        }
+        if audio:
+            entry['audio'] = audio
+            entry['filename'] = filename
+        if body:
+            entry['body'] = body
+        if form:
+            entry['form'] = form
+        line = json.dumps(entry, ensure_ascii=False) + '\n'
+        with self._lock, open(self.log_path, 'a', encoding='utf-8') as f:
+            f.write(line)
+
+
+recorder = SessionRecorder(SESSION_RECORD_DIR) if SESSION_RECORD_DIR else None
+
+
+def start_turn(request, get_session_id):
+    """リクエスト開始時に呼ぶ。記録対象ならアップロード音声を保存し、記録用の情報を返す。"""
+    if recorder is None or request.endpoint not in RECORDED_ENDPOINTS:
+        return None
+    turn = {
+        'session_id': get_session_id(),
+        'route': request.path,
+        'method': request.method,
+        'started_at': time.time(),
+        'perf_started': time.perf_counter(),
+    }
+    if 'audio' in request.files:
+        turn['audio'], turn['filename'] = recorder.save_audio(request.files['audio'])
+        turn['form'] = {key: request.form[key] for key in RECORDED_FORM_KEYS if key in request.form}
+    if request.is_json:
+        data = request.get_json(silent=True) or {}
+        turn['body'] = {key: data[key] for key in RECORDED_JSON_KEYS if key in data}
+    return turn
+
+
+def finish_turn(turn, response):
+    """レスポンスを返し終えた時点 (ストリーミングなら最後まで送った時点) で記録する。"""
+    def write_record():
+        recorder.record(
+            turn['session_id'], turn['route'], turn['method'], turn['started_at'],
+            time.perf_counter() - turn['perf_started'], response.status_code,
+            audio=turn.get('audio'), filename=turn.get('filename'), body=turn.get('body'),
+            form=turn.get('form'))
+
+    response.call_on_close(write_record)
+    return response
@@ -0,0 +1,144 @@
+"""
+recorder.py で記録した面談セッションを、記録どおりの間隔で再生する負荷生成ツール。
+
+    SESSION_RECORD_DIR=recordings python app.py                   # 記録
+    OPENAI_BACKEND=stub gunicorn -c gunicorn.conf.py               # スタブを上流にして起動
+    python replay.py recordings --base-url http://127.0.0.1:8000 --speed 2 --sessions 8
+
+--speed は再生速度 (2 なら間隔を半分に詰める)、--sessions は同時に走らせるセッション数。
+記録したセッション数より多い場合は順に使い回す。
+"""
+import argparse
+import base64
+import collections
+import concurrent.futures
+import json
+import os
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+
+from metrics import LatencyHistogram
+
+
+def load_sessions(record_dir):
+    sessions = collections.defaultdict(list)
+    with open(os.path.join(record_dir, 'turns.jsonl'), encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                turn = json.loads(line)
+                sessions[turn['session']].append(turn)
+    for turns in sessions.values():
+        turns.sort(key=lambda turn: turn['ts'])
+    return [turns for _, turns in sorted(sessions.items(), key=lambda item: item[1][0]['ts'])]
+
+
+def encode_multipart(field, filename, data, fields=None):
+    boundary = uuid.uuid4().hex
+    body = b''.join([
+        *(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+          for name, value in (fields or {}).items()),
+        f'--{boundary}\r\n'.encode(),
+        f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'.encode(),
+        b'Content-Type: application/octet-stream\r\n\r\n',
+        data,
+        f'\r\n--{boundary}--\r\n'.encode(),
+    ])
+    return body, f'multipart/form-data; boundary={boundary}'
+
+
+class Replayer:
+    def __init__(self, record_dir, base_url, speed=1.0, auth=None):
+        self.record_dir = record_dir
+        self.base_url = base_url.rstrip('/')
+        self.speed = speed
+        self.auth_header = None
+        if auth:
+            self.auth_header = 'Basic ' + base64.b64encode(auth.encode()).decode()
+        self.latency = collections.defaultdict(LatencyHistogram)
+        self.errors = collections.Counter()
+        self._lock = threading.Lock()
+
+    def build_request(self, turn):
+        url = self.base_url + turn['route']
+        headers = {}
+        data = None
+        if turn.get('audio'):
+            with open(os.path.join(self.record_dir, turn['audio']), 'rb') as f:
+                data, content_type = encode_multipart(
+                    'audio', turn.get('filename') or 'recording.wav', f.read(), turn.get('form'))
+            headers['Content-Type'] = content_type
+        elif turn['method'] == 'POST':
+            data = json.dumps(turn.get('body', {}), ensure_ascii=False).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        if self.auth_header:
+            headers['Authorization'] = self.auth_header
+        return urllib.request.Request(url, data=data, headers=headers, method=turn['method'])
+
+    def send(self, opener, turn):
+        key = f'{turn["method"]} {turn["route"]}'
+        started = time.perf_counter()
+        try:
+            with opener.open(self.build_request(turn), timeout=300) as response:
+                # ストリーミング応答は最後まで読み切った時点を完了とする
+                while response.read(64 * 1024):
+                    pass
+        except urllib.error.HTTPError as e:
+            with self._lock:
+                self.errors[f'{key} {e.code}'] += 1
+            return
+        except OSError as e:
+            with self._lock:
+                self.errors[f'{key} {type(e).__name__}'] += 1
+            return
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.latency[key].record(elapsed)
+            self.latency['all'].record(elapsed)
+
+    def replay_session(self, turns):
+        # cookie を保持して、/llm_stream の POST → GET のようなセッション依存の流れを再現する
+        opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor())
+        origin = turns[0]['ts']
+        started = time.monotonic()
+        for turn in turns:
+            wait = (turn['ts'] - origin) / self.speed - (time.monotonic() - started)
+            if wait > 0:
+                time.sleep(wait)
+            self.send(opener, turn)
+
+    def run(self, sessions, concurrency):
+        started = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(concurrency) as pool:
+            list(pool.map(lambda i: self.replay_session(sessions[i % len(sessions)]), range(concurrency)))
+        elapsed = time.perf_counter() - started
+        return {
+            'elapsed': round(elapsed, 3),
+            'requests': self.latency['all'].count,
+            'errors': dict(self.errors),
+            'latency': {key: histogram.summary() for key, histogram in sorted(self.latency.items())},
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='記録した面談セッションの再生')
+    parser.add_argument('record_dir', help='SESSION_RECORD_DIR で記録したディレクトリ')
+    parser.add_argument('--base-url', default='http://127.0.0.1:8000')
+    parser.add_argument('--speed', type=float, default=1.0, help='再生速度の倍率')
+    parser.add_argument('--sessions', type=int, default=1, help='同時に再生するセッション数')
+    parser.add_argument('--auth', default=None, help='BASIC 認証 (user:password)')
+    args = parser.parse_args(argv)
+
+    sessions = load_sessions(args.record_dir)
+    if not sessions:
+        raise SystemExit(f'no turns recorded in {args.record_dir}')
+    report = Replayer(args.record_dir, args.base_url, args.speed, args.auth).run(sessions, args.sessions)
+    json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+import contextlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+# gunicorn の全ワーカーで共有する SQLite ファイル
+SHARED_STATE_PATH = os.getenv(
+    'SHARED_STATE_PATH', os.path.join(tempfile.gettempdir(), 'raginterviewee_state.sqlite3'))
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS kv (
+    namespace TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    expires_at REAL,
+    PRIMARY KEY (namespace, key)
+);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+'''
+
+
+class SharedState:
+    """
+    プロセス間で共有する状態 (スレッド対応表・キャッシュ・カウンタ) を SQLite (WAL) に保存する。
+
+    接続はプロセス・スレッドごとに遅延生成するので、preload した後に fork しても安全。
+    """
+    def __init__(self, path=SHARED_STATE_PATH):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(_SCHEMA)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, namespace, key, default=None):
+        row = self._connection().execute(
+            'SELECT value FROM kv WHERE namespace = ? AND key = ? AND (expires_at IS NULL OR expires_at > ?)',
+            (namespace, key, time.time())).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set(self, namespace, key, value, ttl=None):
+        expires_at = time.time() + ttl if ttl else None
+        self._connection().execute(
+            'INSERT OR REPLACE INTO kv (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)',
+            (namespace, key, json.dumps(value, ensure_ascii=False), expires_at))
+
+    def setdefault(self, namespace, key, value, ttl=None):
+        """キーが無ければ value を保存する。他プロセスが先に保存していればそちらを返す。"""
+        conn = self._connection()
+        now = time.time()
+        expires_at = now + ttl if ttl else None
+        with _transaction(conn):
+            conn.execute(
+                'DELETE FROM kv WHERE namespace = ? AND key = ? AND expires_at IS NOT NULL AND expires_at <= ?',
+                (namespace, key, now))
+            conn.execute(
+                'INSERT OR IGNORE INTO kv (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)',
+                (namespace, key, json.dumps(value, ensure_ascii=False), expires_at))
+            row = conn.execute(
+                'SELECT value FROM kv WHERE namespace = ? AND key = ?', (namespace, key)).fetchone()
+        return json.loads(row[0])
+
+    def delete(self, namespace, key):
+        self._connection().execute('DELETE FROM kv WHERE namespace = ? AND key = ?', (namespace, key))
+
+    def purge_expired(self):
+        self._connection().execute(
+            'DELETE FROM kv WHERE expires_at IS NOT NULL AND expires_at <= ?', (time.time(),))
+
+    def incr(self, name, amount=1):
+        conn = self._connection()
+        conn.execute(
+            'INSERT INTO counters (name, value) VALUES (?, ?) '
+            'ON CONFLICT(name) DO UPDATE SET value = value + excluded.value',
+            (name, amount))
+
+    def counters(self, prefix=''):
+        rows = self._connection().execute(
+            'SELECT name, value FROM counters WHERE name LIKE ? ORDER BY name', (prefix + '%',)).fetchall()
+        return dict(rows)
+
+
+@contextlib.contextmanager
+def _transaction(conn):
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+
+
+state = SharedState()
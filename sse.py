@@ -0,0 +1,72 @@
+import json
+import os
+import time
+import zlib
+
+# テキスト差分をまとめて送る時間窓とバイト数の上限
+SSE_COALESCE_MS = float(os.getenv('SSE_COALESCE_MS', '40'))
+SSE_COALESCE_BYTES = int(os.getenv('SSE_COALESCE_BYTES', '512'))
+# クライアントが対応していればストリームを gzip で圧縮する
+SSE_COMPRESS = os.getenv('SSE_COMPRESS', '1') == '1'
+
+# json.dumps にオプションを渡すと毎回エンコーダを作り直すので使い回す
+_json_encode = json.JSONEncoder(ensure_ascii=False).encode
+
+
+def sse_event(payload):
+    """payload を JSON にした SSE イベント。引用符や改行を含むテキストも安全に送れる。"""
+    return f'data: {_json_encode(payload)}\n\n'
+
+
+class DeltaCoalescer:
+    """
+    LLM のトークン差分を時間窓またはバイト数でまとめ、1つの text イベントにする。
+
+    add() はまとめた結果を送るべきときにイベントを返し、それ以外は None を返す。
+    差分以外のイベントが届いたときは poll() で時間窓を過ぎた分を吐き出し、
+    音声合成など時間のかかる処理の前と終了時には flush() で残りを吐き出す。
+    時間窓はイベントが届いたときにしか判定しないので、上流から何も届かない間は
+    受け取り済みのテキストも次のイベントまで待つ (遅れの上限はイベントの間隔で決まる)。
+    """
+    def __init__(self, window_ms=SSE_COALESCE_MS, max_bytes=SSE_COALESCE_BYTES, clock=time.monotonic):
+        self.window = window_ms / 1000.0
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self._parts = []
+        self._size = 0
+        self._started_at = None
+
+    def add(self, text):
+        if not self._parts:
+            self._started_at = self.clock()
+        self._parts.append(text)
+        self._size += len(text.encode('utf-8'))
+        if self._size >= self.max_bytes or self.clock() - self._started_at >= self.window:
+            return self.flush()
+        return None
+
+    def poll(self):
+        """時間窓を過ぎていればまとめた分を返す。"""
+        if self._parts and self.clock() - self._started_at >= self.window:
+            return self.flush()
+        return None
+
+    def flush(self):
+        if not self._parts:
+            return None
+        text = ''.join(self._parts)
+        self._parts = []
+        self._size = 0
+        return sse_event({'text': text})
+
+
+def accepts_gzip(request):
+    return SSE_COMPRESS and 'gzip' in request.headers.get('Accept-Encoding', '')
+
+
+def gzip_stream(events):
+    """イベントごとに Z_SYNC_FLUSH して、圧縮しながらも届いた分はすぐ読めるようにする。"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for event in events:
+        yield compressor.compress(event.encode('utf-8')) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
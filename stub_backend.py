@@ -0,0 +1,209 @@
+"""
+OpenAI API の代わりに使うローカルのスタブ。負荷試験・ベンチマーク用。
+
+OPENAI_BACKEND=stub で app.py がこちらを使う。各段のレイテンシは環境変数で注入できる。
+
+    STUB_LATENCY_STT      文字起こし 1 回あたりの秒数 (既定 0.3)
+    STUB_LATENCY_LLM      アシスタントの run 1 回あたりの秒数 (既定 1.0)
+    STUB_LATENCY_TTS      音声合成 1 回あたりの秒数 (既定 0.3)
+    STUB_LATENCY_TTS_CHAR 音声合成の入力 1 文字あたりの追加秒数 (既定 0.005)
+    STUB_TOKEN_INTERVAL   ストリーミング応答のトークン間隔 (既定 0.02)
+    STUB_MODEL_LATENCY    モデルごとの固定レイテンシの上書き (例: "tts-1-hd=0.8,tts-1=0.2")
+    STUB_TAIL_PROB        文字起こし・音声合成がまれに遅くなる確率 (既定 0)
+    STUB_TAIL_LATENCY     遅くなったときの追加秒数 (既定 2.0)
+
+model_latency は実行中に書き換えてもよい (モデル選択の試験用)。
+"""
+import contextlib
+import io
+import itertools
+import os
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import soundfile as sf
+
+STUB_REPLY = (
+    'ご質問ありがとうございます。私はこれまでバックエンド開発を中心に担当してきました。'
+    '直近ではチームのリーダーとして設計とレビューを行っています。'
+)
+_TTS_SAMPLERATE = 24000
+# 音声合成の出力形式 → soundfile の (format, subtype)
+# aac は libsndfile が書けないので mp3 で代用する
+_SF_FORMATS = {
+    'opus': ('OGG', 'OPUS'),
+    'mp3': ('MP3', 'MPEG_LAYER_III'),
+    'aac': ('MP3', 'MPEG_LAYER_III'),
+    'wav': ('WAV', 'PCM_16'),
+    'flac': ('FLAC', 'PCM_16'),
+}
+
+
+def _env_float(name, default):
+    return float(os.getenv(name, default))
+
+
+def _env_model_latency():
+    latencies = {}
+    for item in os.getenv('STUB_MODEL_LATENCY', '').split(','):
+        if '=' in item:
+            model, seconds = item.split('=', 1)
+            latencies[model.strip()] = float(seconds)
+    return latencies
+
+
+class StubOpenAI:
+    def __init__(self, api_key=None, **kwargs):
+        self.latency_stt = _env_float('STUB_LATENCY_STT', 0.3)
+        self.latency_llm = _env_float('STUB_LATENCY_LLM', 1.0)
+        self.latency_tts = _env_float('STUB_LATENCY_TTS', 0.3)
+        self.latency_tts_char = _env_float('STUB_LATENCY_TTS_CHAR', 0.005)
+        self.token_interval = _env_float('STUB_TOKEN_INTERVAL', 0.02)
+        self.model_latency = _env_model_latency()
+        self.tail_prob = _env_float('STUB_TAIL_PROB', 0.0)
+        self.tail_latency = _env_float('STUB_TAIL_LATENCY', 2.0)
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._threads = {}
+        self._runs = {}
+
+        self.audio = SimpleNamespace(
+            transcriptions=SimpleNamespace(create=self._transcribe),
+            speech=SimpleNamespace(
+                create=self._speech,
+                with_streaming_response=SimpleNamespace(create=self._speech_streaming),
+            ),
+        )
+        self.beta = SimpleNamespace(
+            assistants=SimpleNamespace(retrieve=self._retrieve_assistant),
+            threads=SimpleNamespace(
+                create=self._create_thread,
+                create_and_run_stream=self._create_and_run_stream,
+                messages=SimpleNamespace(create=self._create_message, list=self._list_messages),
+                runs=SimpleNamespace(create=self._create_run, retrieve=self._retrieve_run, cancel=self._cancel_run),
+            ),
+        )
+
+    def _latency(self, model, default):
+        return self.model_latency.get(model, default)
+
+    def _tail(self):
+        """テールレイテンシの注入。tail_prob の確率で tail_latency 秒を足す。"""
+        return self.tail_latency if random.random() < self.tail_prob else 0.0
+
+    def _new_id(self, prefix):
+        return f'{prefix}_stub{os.getpid()}_{next(self._ids)}'
+
+    # 文字起こし
+    def _transcribe(self, model, file, **kwargs):
+        if isinstance(file, tuple):
+            file = file[1]
+        size = 0
+        while True:
+            chunk = file.read(64 * 1024)
+            if not chunk:
+                break
+            size += len(chunk)
+        time.sleep(self._latency(model, self.latency_stt) + self._tail())
+        return SimpleNamespace(text=f'スタブの文字起こしです（{size} バイト）。自己紹介をお願いします。')
+
+    # 音声合成
+    def synthesize(self, text, response_format='mp3'):
+        # 1文字あたり 0.1 秒の無音に近い音声を作る
+        frames = max(1, int(len(text) * 0.1 * _TTS_SAMPLERATE))
+        samples = (np.sin(np.arange(frames) * 2 * np.pi * 220 / _TTS_SAMPLERATE) * 0.01).astype('float32')
+        if response_format == 'pcm':
+            return (samples * 32767).astype('<i2').tobytes()
+        format, subtype = _SF_FORMATS[response_format]
+        buffer = io.BytesIO()
+        sf.write(buffer, samples, _TTS_SAMPLERATE, format=format, subtype=subtype)
+        return buffer.getvalue()
+
+    def _speech(self, model, voice, input, response_format='mp3', **kwargs):
+        time.sleep(self._latency(model, self.latency_tts) + self.latency_tts_char * len(input) + self._tail())
+        return SimpleNamespace(content=self.synthesize(input, response_format))
+
+    @contextlib.contextmanager
+    def _speech_streaming(self, model, voice, input, response_format='mp3', **kwargs):
+        content = self.synthesize(input, response_format)
+        # 最初のチャンクまでは固定レイテンシ、残りは文字数に比例して届く
+        total_delay = self.latency_tts_char * len(input)
+
+        def iter_bytes(chunk_size=4096):
+            time.sleep(self._latency(model, self.latency_tts) + self._tail())
+            chunks = max(1, -(-len(content) // chunk_size))
+            for offset in range(0, len(content), chunk_size):
+                yield content[offset:offset + chunk_size]
+                time.sleep(total_delay / chunks)
+
+        yield SimpleNamespace(iter_bytes=iter_bytes)
+
+    # アシスタント
+    def _retrieve_assistant(self, assistant_id, **kwargs):
+        return SimpleNamespace(id=assistant_id)
+
+    def _create_thread(self, **kwargs):
+        thread_id = self._new_id('thread')
+        with self._lock:
+            self._threads[thread_id] = []
+        return SimpleNamespace(id=thread_id)
+
+    def _messages(self, thread_id):
+        # 他のワーカーで作られたスレッドも受け付ける
+        with self._lock:
+            return self._threads.setdefault(thread_id, [])
+
+    def _create_message(self, thread_id, role, content, **kwargs):
+        message = SimpleNamespace(
+            id=self._new_id('msg'), role=role,
+            content=[SimpleNamespace(text=SimpleNamespace(value=content))])
+        self._messages(thread_id).append(message)
+        return message
+
+    def _create_run(self, thread_id, assistant_id, model=None, **kwargs):
+        run_id = self._new_id('run')
+        with self._lock:
+            self._runs[run_id] = (thread_id, time.monotonic() + self._latency(model, self.latency_llm))
+        return SimpleNamespace(id=run_id, status='queued')
+
+    def _retrieve_run(self, thread_id, run_id, **kwargs):
+        with self._lock:
+            _, done_at = self._runs[run_id]
+        if time.monotonic() < done_at:
+            return SimpleNamespace(id=run_id, status='in_progress')
+        with self._lock:
+            finished = self._runs.pop(run_id, None)
+        if finished:
+            self._create_message(thread_id, 'assistant', STUB_REPLY)
+        return SimpleNamespace(id=run_id, status='completed')
+
+    def _cancel_run(self, thread_id, run_id, **kwargs):
+        with self._lock:
+            self._runs.pop(run_id, None)
+        return SimpleNamespace(id=run_id, status='cancelled')
+
+    def _list_messages(self, thread_id, order='asc', **kwargs):
+        data = list(self._messages(thread_id))
+        if order == 'desc':
+            data.reverse()
+        return SimpleNamespace(data=data)
+
+    @contextlib.contextmanager
+    def _create_and_run_stream(self, assistant_id, thread=None, model=None, **kwargs):
+        thread_id = self._create_thread().id
+        run_id = self._new_id('run')
+
+        def events():
+            run = SimpleNamespace(id=run_id, thread_id=thread_id, status='queued')
+            yield SimpleNamespace(event='thread.run.created', data=run)
+            time.sleep(self._latency(model, self.latency_llm))
+            for char in STUB_REPLY:
+                delta = SimpleNamespace(content=[SimpleNamespace(text=SimpleNamespace(value=char))])
+                yield SimpleNamespace(event='thread.message.delta', data=SimpleNamespace(delta=delta))
+                time.sleep(self.token_interval)
+            yield SimpleNamespace(event='thread.run.completed', data=SimpleNamespace())
+
+        yield events()
@@ -0,0 +1,78 @@
+"""
+audio_concat.py でつないだ音声が、各パートの長さの合計としてデコードされるかを確かめる。
+
+    python -m pytest tests
+"""
+import io
+import os
+import struct
+import sys
+import unittest
+
+import soundfile as sf
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from audio_concat import concat_audio, _opus_pages  # noqa: E402
+from stub_backend import StubOpenAI, _TTS_SAMPLERATE  # noqa: E402
+
+# 長さの違うパートをつなぐ (スタブは1文字 0.1 秒)
+TEXTS = ['あ' * n for n in (100, 120, 90, 110, 80, 100)]
+# Opus のグラニュール位置は常に 48kHz
+OPUS_RATE = 48000
+# mp3 のつなぎ目に入るエンコーダの遅延と詰め物の上限 (フレーム数)
+MP3_SEAM_FRAMES = 3
+MP3_FRAME_SAMPLES = 576 if _TTS_SAMPLERATE < 32000 else 1152
+
+
+def decoded_frames(data):
+    audio, _ = sf.read(io.BytesIO(data))
+    return len(audio)
+
+
+def opus_seam_samples(previous, following):
+    # 前のパートの末尾の詰め物 (パケットのサンプル数 - 最後のグラニュール位置) と次のパートの pre-skip
+    pages = list(_opus_pages(previous))
+    padding = pages[-1][6] - pages[-1][1]
+    pre_skip, = struct.unpack_from('<H', list(_opus_pages(following))[0][4], 10)
+    return padding + pre_skip
+
+
+class ConcatAudioTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.stub = StubOpenAI()
+
+    def parts(self, response_format):
+        return [self.stub.synthesize(text, response_format) for text in TEXTS]
+
+    def test_wav(self):
+        parts = self.parts('wav')
+        self.assertEqual(decoded_frames(concat_audio(parts, 'wav')), sum(map(decoded_frames, parts)))
+
+    def test_pcm(self):
+        parts = self.parts('pcm')
+        self.assertEqual(len(concat_audio(parts, 'pcm')), sum(map(len, parts)))
+
+    def test_opus(self):
+        parts = self.parts('opus')
+        seams = sum(opus_seam_samples(a, b) for a, b in zip(parts, parts[1:]))
+        expected = sum(map(decoded_frames, parts)) + seams * _TTS_SAMPLERATE // OPUS_RATE
+        self.assertEqual(decoded_frames(concat_audio(parts, 'opus')), expected)
+
+    def test_mp3(self):
+        parts = self.parts('mp3')
+        extra = decoded_frames(concat_audio(parts, 'mp3')) - sum(map(decoded_frames, parts))
+        self.assertGreaterEqual(extra, 0)
+        self.assertLessEqual(extra, (len(parts) - 1) * MP3_SEAM_FRAMES * MP3_FRAME_SAMPLES)
+
+    def test_single_part_is_unchanged(self):
+        part = self.stub.synthesize(TEXTS[0], 'opus')
+        self.assertIs(concat_audio([part], 'opus'), part)
+
+    def test_flac_is_rejected(self):
+        with self.assertRaises(ValueError):
+            concat_audio(self.parts('flac')[:2], 'flac')
+
+
+if __name__ == '__main__':
+    unittest.main()
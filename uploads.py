@@ -0,0 +1,121 @@
+import io
+import os
+import tempfile
+
+from flask import Request
+
+# アップロードの上限サイズ (Whisper API の上限に合わせて既定 25MB)
+MAX_UPLOAD_BYTES = int(float(os.getenv('MAX_UPLOAD_MB', '25')) * 1024 * 1024)
+# これを超えたアップロードはメモリではなく一時ファイルに置く
+SPOOL_THRESHOLD_BYTES = int(os.getenv('UPLOAD_SPOOL_KB', '512')) * 1024
+# 変換が必要な場合にデコードするブロックのフレーム数
+DECODE_BLOCK_FRAMES = 64 * 1024
+
+# 文字起こし API がそのまま受け付ける形式
+STT_PASSTHROUGH_EXTENSIONS = ('.flac', '.m4a', '.mp3', '.mp4', '.mpeg', '.mpga', '.oga', '.ogg', '.wav', '.webm')
+
+
+class SpooledUploadRequest(Request):
+    """
+    アップロードファイルを SPOOL_THRESHOLD_BYTES までメモリに持ち、
+    それを超えたら一時ファイルへ逃がす Request。
+    """
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.SpooledTemporaryFile(max_size=SPOOL_THRESHOLD_BYTES, mode='w+b')
+
+
+def stream_filename(audio_stream, default='input.wav'):
+    name = getattr(audio_stream, 'name', None)
+    if isinstance(name, str) and name:
+        return os.path.basename(name)
+    return default
+
+
+def prepare_stt_file(audio_stream, filename=None):
+    """
+    文字起こし API に渡す (ファイル名, ファイルオブジェクト) を返す。
+
+    API が受け付ける形式ならコピーせずにそのまま渡す。
+    それ以外はブロック単位でデコードし、一時ファイルに WAV として書き出す。
+    """
+    filename = filename or stream_filename(audio_stream)
+    audio_stream.seek(0)
+    if filename.lower().endswith(STT_PASSTHROUGH_EXTENSIONS):
+        return filename, audio_stream
+
+    # soundfile (numpy) は変換が必要なときだけ読み込む
+    import soundfile as sf
+    info = sf.info(audio_stream)
+    audio_stream.seek(0)
+    wav_file = tempfile.SpooledTemporaryFile(max_size=SPOOL_THRESHOLD_BYTES, mode='w+b')
+    with sf.SoundFile(wav_file, 'w', samplerate=info.samplerate, channels=info.channels,
+                      format='WAV', subtype='PCM_16') as out:
+        for block in sf.blocks(audio_stream, blocksize=DECODE_BLOCK_FRAMES, dtype='int16'):
+            out.write(block)
+    wav_file.seek(0)
+    return 'input.wav', wav_file
+
+
+class _PositionalReader(io.RawIOBase):
+    """read_at(size, offset) で読む、自分だけの読み取り位置を持つリーダー。"""
+    def __init__(self, read_at, length):
+        self._read_at = read_at
+        self._length = length
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._read_at(min(len(buffer), max(self._length - self._position, 0)), self._position)
+        buffer[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._position, io.SEEK_END: self._length}[whence]
+        self._position = max(base + offset, 0)
+        return self._position
+
+    def tell(self):
+        return self._position
+
+
+class SharedUpload:
+    """
+    同じアップロードを複数の送信から同時に読むためのラッパー。
+
+    reader() ごとに読み取り位置が独立したリーダーを返す。元のファイルはコピーせず、
+    ディスク上なら os.pread、メモリ上ならバッファから直接読む。
+    """
+    def __init__(self, stream):
+        if isinstance(stream, tempfile.SpooledTemporaryFile):
+            # メモリ上の内部バッファは共有できないので一時ファイルに逃がす
+            stream.rollover()
+        if isinstance(stream, io.BytesIO):
+            data = stream.getvalue()
+            self.length = len(data)
+            self._read_at = lambda size, offset: data[offset:offset + size]
+        elif hasattr(os, 'pread') and _has_fileno(stream):
+            fd = stream.fileno()
+            self.length = os.fstat(fd).st_size
+            self._read_at = lambda size, offset: os.pread(fd, size, offset)
+        else:
+            stream.seek(0)
+            data = stream.read()
+            self.length = len(data)
+            self._read_at = lambda size, offset: data[offset:offset + size]
+
+    def reader(self):
+        return _PositionalReader(self._read_at, self.length)
+
+
+def _has_fileno(stream):
+    try:
+        stream.fileno()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return False
+    return True